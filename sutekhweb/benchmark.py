@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Benchmark the web app against a synthetic card database.
+
+   Run with 'python -m sutekhweb.benchmark --help' for the options.
+   The views are driven through Flask's test client, so no server or
+   network is needed."""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import quote
+
+from sqlobject import sqlhub, connectionForURI
+
+from sutekh.base.core.BaseTables import PhysicalCardSet
+from sutekh.base.core.DBUtility import (refresh_tables, init_cache,
+                                        make_adapter_caches)
+from sutekh.base.Utility import sqlite_uri
+from sutekh.core.SutekhTables import TABLE_LIST
+from sutekh.core.SutekhObjectMaker import SutekhObjectMaker
+
+from sutekhweb import metrics
+from sutekhweb.cache import flush_caches
+from sutekhweb.db import init_join_caches
+from sutekhweb.sutekhweb import (app, DefConfig, configure_caches, CARD_INDEX,
+                                 SEARCH_INDEX)
+
+CARD_TYPES = ['Vampire', 'Imbued', 'Master', 'Action', 'Action Modifier',
+              'Combat', 'Reaction', 'Ally', 'Equipment', 'Political Action']
+CLANS = ['Brujah', 'Gangrel', 'Malkavian', 'Nosferatu', 'Toreador',
+         'Tremere', 'Ventrue']
+CREEDS = ['Defender', 'Innocent', 'Judge', 'Martyr', 'Redeemer']
+DISCIPLINES = ['Animalism', 'Auspex', 'Celerity', 'Dominate', 'Fortitude',
+               'Obfuscate', 'Potence', 'Presence', 'Thaumaturgy']
+VIRTUES = ['Defense', 'Innocence', 'Judgment', 'Martyrdom', 'Redemption']
+EXPANSIONS = ['Jyhad', 'Vampire: The Eternal Struggle', 'Sabbat',
+              'Third Edition', 'Keepers of Tradition']
+RARITIES = ['Common', 'Uncommon', 'Rare', 'Precon']
+KEYWORDS = ['burn option', 'advanced', 'unique', 'weapon', 'gun']
+
+# The percentiles reported for each view
+PERCENTILES = (50, 90, 95, 99)
+
+
+def make_database(sPath, iCards, iSets, iDepth, iCardsPerSet, iSeed=1):
+    """Create a synthetic card database at sPath.
+
+       The card sets form a tree at most iDepth levels deep."""
+    if os.path.exists(sPath):
+        os.remove(sPath)
+    oConn = connectionForURI(sqlite_uri(sPath))
+    sqlhub.processConnection = oConn
+    # We're creating a throwaway database, so trade safety for speed
+    oConn.query('PRAGMA synchronous = OFF')
+    oConn.query('PRAGMA journal_mode = MEMORY')
+    refresh_tables(TABLE_LIST, oConn)
+    oMaker = SutekhObjectMaker()
+    for sDomain, aValues in [('CardTypes', CARD_TYPES), ('Clans', CLANS),
+                             ('Creeds', CREEDS),
+                             ('Disciplines', DISCIPLINES),
+                             ('Virtues', VIRTUES),
+                             ('Expansions', EXPANSIONS),
+                             ('Rarities', RARITIES)]:
+        for sValue in aValues:
+            oMaker.make_lookup_hint(sDomain, sValue, sValue)
+    make_adapter_caches()
+    oRand = random.Random(iSeed)
+    aExpansions = [oMaker.make_expansion(x) for x in EXPANSIONS]
+    for sRarity in RARITIES:
+        oMaker.make_rarity(sRarity)
+    aPrintings = [oMaker.make_default_printing(x) for x in aExpansions]
+    aKeywords = [oMaker.make_keyword(x) for x in KEYWORDS]
+    aCards = []
+    for iNum in range(iCards):
+        oCard = oMaker.make_abstract_card('Card %d' % iNum)
+        sType = oRand.choice(CARD_TYPES)
+        oCard.addCardType(oMaker.make_card_type(sType))
+        if sType == 'Vampire':
+            oCard.addClan(oMaker.make_clan(oRand.choice(CLANS)))
+            for sDis in oRand.sample(DISCIPLINES, oRand.randint(1, 4)):
+                oCard.addDisciplinePair(oMaker.make_discipline_pair(
+                    sDis, oRand.choice(['inferior', 'superior'])))
+            oCard.group = oRand.randint(1, 6)
+            oCard.capacity = oRand.randint(1, 11)
+        elif sType == 'Imbued':
+            oCard.addCreed(oMaker.make_creed(oRand.choice(CREEDS)))
+            for sVirtue in oRand.sample(VIRTUES, oRand.randint(1, 3)):
+                oCard.addVirtue(oMaker.make_virtue(sVirtue))
+            oCard.group = oRand.randint(1, 6)
+            oCard.life = oRand.randint(3, 7)
+        else:
+            if oRand.random() < 0.5:
+                oCard.addDisciplinePair(oMaker.make_discipline_pair(
+                    oRand.choice(DISCIPLINES), 'inferior'))
+            if oRand.random() < 0.3:
+                oCard.addClan(oMaker.make_clan(oRand.choice(CLANS)))
+            oCard.cost = oRand.randint(0, 4)
+            oCard.costtype = oRand.choice(['pool', 'blood'])
+        if oRand.random() < 0.2:
+            oCard.addKeyword(oRand.choice(aKeywords))
+        oCard.text = ' '.join(['Text for card %d.' % iNum] +
+                              oRand.sample(DISCIPLINES + CLANS, 5))
+        oCard.search_text = oCard.text
+        for oExp in oRand.sample(aExpansions, oRand.randint(1, 3)):
+            oCard.addRarityPair(oMaker.make_rarity_pair(
+                oExp.name, oRand.choice(RARITIES)))
+        oCard.syncUpdate()
+        # pylint: disable=protected-access
+        # The text is stored on the base card, as in WhiteWolfTextParser
+        oCard._parent.syncUpdate()
+        aCards.append(oCard)
+    init_cache()
+    # Each card set's parent is picked from the sets already created
+    # which aren't yet at the maximum depth
+    aSetDepths = []
+    for iNum in range(iSets):
+        aParents = [(oCS, iLevel) for oCS, iLevel in aSetDepths
+                    if iLevel < iDepth - 1]
+        if aParents and oRand.random() < 0.7:
+            oParent, iLevel = oRand.choice(aParents)
+            iLevel += 1
+        else:
+            oParent, iLevel = None, 0
+        oCS = PhysicalCardSet(name='Card Set %d' % iNum, parent=oParent,
+                              inuse=oRand.random() < 0.2)
+        aSetDepths.append((oCS, iLevel))
+        for _iCard in range(iCardsPerSet):
+            oCS.addPhysicalCard(oMaker.make_physical_card(
+                oRand.choice(aCards), oRand.choice(aPrintings + [None])))
+    return oConn
+
+
+def get_scenarios(iSets):
+    """Return the (name, method, url, form data) for each benchmark.
+
+       Card set views use a set from the middle of the tree"""
+    sSet = quote('Card Set %d' % (iSets // 2), safe='')
+    sFilter = quote('CardType = "Vampire"', safe='')
+    return [
+        ('cardlist', 'GET', '/cardlist', None),
+        ('cardlist_filtered', 'GET',
+         '/cardlist/Clan%%20or%%20Creed?filter=%s' % sFilter, None),
+        ('cardsets', 'GET', '/cardsets', None),
+        ('cardsetview', 'GET', '/cardsetview/%s' % sSet, None),
+        ('cardsetview_expansions', 'GET',
+         '/cardsetview/%s/Card%%20Type/Show' % sSet, None),
+        ('cardsetview_filtered', 'GET',
+         '/cardsetview/%s/Card%%20Type/Hide?filter=%s' % (sSet, sFilter),
+         None),
+        ('cardsetview_filtered_expansions', 'GET',
+         '/cardsetview/%s/Card%%20Type/Show?filter=%s' % (sSet, sFilter),
+         None),
+        ('print_card', 'GET', '/card/Card%201', None),
+        ('search', 'POST', '/search/Card%20Text', {'searchtext': 'potence'}),
+        ('search_suggest', 'GET', '/search/suggest?q=card%201', None),
+        ('download', 'POST', '/cardsetview/%s' % sSet,
+         {'download': 'Download'}),
+    ]
+
+
+def percentile(aValues, iPercent):
+    """Return the given percentile of the sorted list aValues"""
+    if not aValues:
+        return 0.0
+    iPos = (len(aValues) - 1) * iPercent / 100.0
+    iLow = int(iPos)
+    iHigh = min(iLow + 1, len(aValues) - 1)
+    return aValues[iLow] + (aValues[iHigh] - aValues[iLow]) * (iPos - iLow)
+
+
+def do_request(oClient, sMethod, sUrl, dData):
+    """Make the request and read the whole response"""
+    if sMethod == 'POST':
+        oResponse = oClient.post(sUrl, data=dData)
+    else:
+        oResponse = oClient.get(sUrl)
+    oResponse.get_data()
+    return oResponse.status_code
+
+
+def run_scenario(oClient, sMethod, sUrl, dData, iRepeat, bCold):
+    """Time iRepeat requests to the url, and measure the query count
+       and peak memory use.
+
+       If bCold is set, the caches are flushed before each request."""
+    # Warm up, so the first request doesn't skew the numbers unless
+    # we're explicitly measuring cold requests
+    iStatus = do_request(oClient, sMethod, sUrl, dData)
+    aTimes = []
+    metrics.REGISTRY.clear()
+    for _iRun in range(iRepeat):
+        if bCold:
+            flush_caches()
+        fStart = time.perf_counter()
+        do_request(oClient, sMethod, sUrl, dData)
+        aTimes.append(time.perf_counter() - fStart)
+    aTimes.sort()
+    iQueries = 0
+    iCount = 0
+    for sEndpoint in ('cardlist', 'cardsets', 'cardsetview', 'print_card',
+                      'simple_search', 'search_suggest'):
+        dTotals = metrics.REGISTRY.get_totals(sEndpoint)
+        if dTotals:
+            iQueries += dTotals['queries']
+            iCount += dTotals['count']
+    # tracemalloc slows things down a lot, so measure memory separately
+    if bCold:
+        flush_caches()
+    tracemalloc.start()
+    do_request(oClient, sMethod, sUrl, dData)
+    _iCurrent, iPeak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    dResult = {
+        'status': iStatus,
+        'runs': iRepeat,
+        'mean': sum(aTimes) / len(aTimes),
+        'queries': float(iQueries) / max(iCount, 1),
+        'peak_memory': iPeak,
+    }
+    for iPercent in PERCENTILES:
+        dResult['p%d' % iPercent] = percentile(aTimes, iPercent)
+    return dResult
+
+
+def run_benchmarks(oArgs):
+    """Run all the benchmarks, and return the results"""
+    app.config.from_object(DefConfig)
+    app.config['METRICS'] = True
+    # Conditional GETs would short-circuit the views we want to measure
+    app.config['HTTP_CACHING'] = False
+    app.config['ICONS'] = oArgs.icons
+    configure_caches()
+    if app.config['USE_CARD_INDEX']:
+        CARD_INDEX.build()
+    SEARCH_INDEX.build()
+    oClient = app.test_client()
+    dResults = {}
+    for sName, sMethod, sUrl, dData in get_scenarios(oArgs.sets):
+        if oArgs.only and sName not in oArgs.only:
+            continue
+        dResults[sName] = run_scenario(oClient, sMethod, sUrl, dData,
+                                       oArgs.repeat, oArgs.cold)
+    return dResults
+
+
+def print_results(dResults, dBaseline=None):
+    """Print a table of the results, with the change from the baseline
+       if given"""
+    sHeader = '%-32s %6s' % ('view', 'status')
+    for iPercent in PERCENTILES:
+        sHeader += ' %9s' % ('p%d ms' % iPercent)
+    sHeader += ' %8s %10s' % ('queries', 'peak KiB')
+    print(sHeader)
+    for sName, dResult in dResults.items():
+        sLine = '%-32s %6d' % (sName, dResult['status'])
+        for iPercent in PERCENTILES:
+            sLine += ' %9.2f' % (dResult['p%d' % iPercent] * 1000)
+        sLine += ' %8.1f %10d' % (dResult['queries'],
+                                  dResult['peak_memory'] // 1024)
+        print(sLine)
+        if dBaseline and sName in dBaseline:
+            dOld = dBaseline[sName]
+            sLine = '%-32s %6s' % ('  vs baseline', '')
+            for iPercent in PERCENTILES:
+                sLine += ' %8.0f%%' % percent_change(
+                    dOld['p%d' % iPercent], dResult['p%d' % iPercent])
+            sLine += ' %7.0f%% %9.0f%%' % (
+                percent_change(dOld['queries'], dResult['queries']),
+                percent_change(dOld['peak_memory'], dResult['peak_memory']))
+            print(sLine)
+
+
+def percent_change(fOld, fNew):
+    """Return the change from fOld to fNew as a percentage"""
+    if not fOld:
+        return 0.0 if not fNew else 100.0
+    return (fNew - fOld) * 100.0 / fOld
+
+
+def find_regressions(dResults, dBaseline, fTolerance):
+    """Return the list of views which are slower, use more queries or
+       use more memory than the baseline by more than fTolerance percent"""
+    aRegressions = []
+    for sName, dResult in dResults.items():
+        dOld = dBaseline.get(sName)
+        if not dOld:
+            continue
+        for sKey in ('p50', 'p95', 'queries', 'peak_memory'):
+            fChange = percent_change(dOld[sKey], dResult[sKey])
+            if fChange > fTolerance:
+                aRegressions.append('%s: %s %+.0f%%' % (sName, sKey,
+                                                        fChange))
+    return aRegressions
+
+
+def main(aArgs=None):
+    """Parse the command line & run the benchmarks"""
+    oParser = argparse.ArgumentParser(
+        description='Benchmark Sutekh-Web against a synthetic database')
+    oParser.add_argument('--db', help='Database file to use. It is created'
+                         ' if it doesn\'t exist (or --rebuild is given)')
+    oParser.add_argument('--rebuild', action='store_true',
+                         help='Recreate the database')
+    oParser.add_argument('--cards', type=int, default=2000,
+                         help='Number of cards in the card list')
+    oParser.add_argument('--sets', type=int, default=100,
+                         help='Number of card sets')
+    oParser.add_argument('--depth', type=int, default=4,
+                         help='Maximum depth of the card set tree')
+    oParser.add_argument('--cards-per-set', type=int, default=60,
+                         help='Number of cards in each card set')
+    oParser.add_argument('--seed', type=int, default=1,
+                         help='Random seed for the generated database')
+    oParser.add_argument('--repeat', type=int, default=20,
+                         help='Number of timed requests per view')
+    oParser.add_argument('--cold', action='store_true',
+                         help='Flush the caches before each request')
+    oParser.add_argument('--icons', action='store_true',
+                         help='Render the pages with icons')
+    oParser.add_argument('--only', action='append',
+                         help='Only run the given view (may be repeated)')
+    oParser.add_argument('--save', metavar='FILE',
+                         help='Save the results as a baseline')
+    oParser.add_argument('--compare', metavar='FILE',
+                         help='Compare the results with a saved baseline')
+    oParser.add_argument('--tolerance', type=float, default=20.0,
+                         help='Percentage change from the baseline which'
+                         ' counts as a regression')
+    oArgs = oParser.parse_args(aArgs)
+
+    sPath = oArgs.db
+    if not sPath:
+        sPath = os.path.join(tempfile.gettempdir(),
+                             'sutekhweb-bench-%d-%d-%d-%d-%d.db' % (
+                                 oArgs.cards, oArgs.sets, oArgs.depth,
+                                 oArgs.cards_per_set, oArgs.seed))
+    if oArgs.rebuild or not os.path.exists(sPath):
+        print('Creating database %s' % sPath)
+        fStart = time.perf_counter()
+        make_database(sPath, oArgs.cards, oArgs.sets, oArgs.depth,
+                      oArgs.cards_per_set, oArgs.seed)
+        print('Created in %.1fs' % (time.perf_counter() - fStart))
+    else:
+        sqlhub.processConnection = connectionForURI(sqlite_uri(sPath))
+        fStart = time.perf_counter()
+        init_join_caches()
+        print('Caches loaded in %.1fs' % (time.perf_counter() - fStart))
+    dResults = run_benchmarks(oArgs)
+
+    dBaseline = None
+    if oArgs.compare:
+        with open(oArgs.compare) as oFile:
+            dBaseline = json.load(oFile)['results']
+    print_results(dResults, dBaseline)
+    if oArgs.save:
+        dParams = {'cards': oArgs.cards, 'sets': oArgs.sets,
+                   'depth': oArgs.depth,
+                   'cards_per_set': oArgs.cards_per_set,
+                   'seed': oArgs.seed, 'repeat': oArgs.repeat,
+                   'cold': oArgs.cold, 'icons': oArgs.icons}
+        with open(oArgs.save, 'w') as oFile:
+            json.dump({'params': dParams, 'results': dResults}, oFile,
+                      indent=2, sort_keys=True)
+        print('Saved baseline to %s' % oArgs.save)
+    if dBaseline:
+        aRegressions = find_regressions(dResults, dBaseline,
+                                        oArgs.tolerance)
+        if aRegressions:
+            print('Regressions:')
+            for sRegression in aRegressions:
+                print('  %s' % sRegression)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Caching helpers for the web app.
+
+   Results are cached in-process and discarded whenever the database
+   changes underneath us."""
+
+import datetime
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlobject import sqlhub
+
+# Bumped by flush_caches, so changes we can't detect from the file system
+# (non-sqlite databases, in-memory databases) can still clear the caches
+_iLocalGeneration = 0
+# Without a database file to check, we can't tell whether the database
+# changed while we weren't running, so we include the start time
+_fStartTime = time.time()
+# Numbers the requests handled by each thread, for databases where we
+# can't detect changes
+_oRequest = threading.local()
+_oRequestNumbers = itertools.count()
+
+
+def _stat_file(sFileName):
+    """Return (mtime, size) for the file, or None if it doesn't exist"""
+    try:
+        oStat = os.stat(sFileName)
+    except OSError:
+        return None
+    return (oStat.st_mtime_ns, oStat.st_size)
+
+
+def _get_db_file():
+    """Return the file name of the sqlite database, or None if the
+       database isn't a sqlite file"""
+    try:
+        oConn = sqlhub.processConnection
+    except AttributeError:
+        # No connection set up yet
+        return None
+    sFileName = getattr(oConn, 'filename', None)
+    if not sFileName or sFileName == ':memory:':
+        return None
+    return sFileName
+
+
+def can_detect_changes():
+    """Return True if we can tell when other processes change the
+       database, so cached results can be kept between requests"""
+    return _get_db_file() is not None
+
+
+def start_request():
+    """Note the start of a new request in this thread.
+
+       If we can't detect changes to the database, results are only
+       cached for the rest of the request, so each request sees the
+       current state of the database."""
+    _oRequest.iNumber = next(_oRequestNumbers)
+
+
+def get_db_generation():
+    """Return a token that changes whenever the database changes.
+
+       For sqlite databases, this is derived from the database file (and
+       the write-ahead log, if present), so changes made by other processes,
+       such as the Sutekh gui, are noticed. For other databases, the token
+       changes with every request, as well as when flush_caches is
+       called."""
+    sFileName = _get_db_file()
+    if sFileName:
+        return (_iLocalGeneration, _stat_file(sFileName),
+                _stat_file(sFileName + '-wal'))
+    return (_iLocalGeneration, _fStartTime,
+            getattr(_oRequest, 'iNumber', None))
+
+
+def get_db_modified():
+    """Return the time the sqlite database file was last modified, as a
+       UTC datetime, or None if it isn't known."""
+    sFileName = _get_db_file()
+    if not sFileName:
+        return None
+    aTimes = []
+    for sName in (sFileName, sFileName + '-wal'):
+        try:
+            aTimes.append(os.stat(sName).st_mtime)
+        except OSError:
+            pass
+    if not aTimes:
+        return None
+    return datetime.datetime.fromtimestamp(int(max(aTimes)),
+                                           datetime.timezone.utc)
+
+
+def flush_caches():
+    """Explicitly mark all cached results as out of date"""
+    global _iLocalGeneration
+    _iLocalGeneration += 1
+
+
+class ResultCache(object):
+    """A thread-safe LRU cache which is emptied when the database changes.
+
+       A maximum size of 0 disables the cache."""
+
+    def __init__(self, iMaxSize):
+        self.iMaxSize = iMaxSize
+        self._dCache = OrderedDict()
+        self._oGeneration = None
+        self._oLock = threading.Lock()
+
+    def _check_generation(self):
+        """Clear the cache if the database has changed.
+
+           Must be called with the lock held."""
+        oGeneration = get_db_generation()
+        if oGeneration != self._oGeneration:
+            self._dCache.clear()
+            self._oGeneration = oGeneration
+
+    def get(self, oKey):
+        """Return the cached value for oKey, or None if it isn't cached"""
+        if not self.iMaxSize:
+            return None
+        with self._oLock:
+            self._check_generation()
+            oValue = self._dCache.get(oKey)
+            if oValue is not None:
+                self._dCache.move_to_end(oKey)
+            return oValue
+
+    def set(self, oKey, oValue):
+        """Add a value to the cache, discarding the oldest entries
+           if needed"""
+        if not self.iMaxSize:
+            return
+        with self._oLock:
+            self._check_generation()
+            self._dCache[oKey] = oValue
+            self._dCache.move_to_end(oKey)
+            while len(self._dCache) > self.iMaxSize:
+                self._dCache.popitem(last=False)
+
+    def __len__(self):
+        return len(self._dCache)
+
+    def clear(self):
+        """Empty the cache"""
+        with self._oLock:
+            self._dCache.clear()
+
+    def resize(self, iMaxSize):
+        """Change the maximum size of the cache"""
+        with self._oLock:
+            self.iMaxSize = iMaxSize
+            while len(self._dCache) > max(iMaxSize, 0):
+                self._dCache.popitem(last=False)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""In-memory index of the card list, used to answer the common list
+   filters without going back to the database."""
+
+import threading
+
+from sqlobject.sqlbuilder import Select
+
+from sutekh.base.core.BaseTables import AbstractCard
+from sutekh.base.core.BaseFilters import (FilterAndBox, FilterOrBox,
+                                          FilterNot, NullFilter,
+                                          NotNullFilter, MultiCardTypeFilter,
+                                          MultiKeywordFilter)
+from sutekh.core.Filters import (MultiClanFilter, MultiVirtueFilter,
+                                 MultiCreedFilter, MultiDisciplineFilter)
+
+from sutekhweb.cache import get_db_generation
+
+# Map the indexed filters to the mapping table and column their ids
+# refer to
+INDEXED_FILTERS = {
+    MultiCardTypeFilter: ('abs_type_map', 'card_type_id'),
+    MultiDisciplineFilter: ('abs_discipline_pair_map', 'discipline_pair_id'),
+    MultiVirtueFilter: ('abs_virtue_map', 'virtue_id'),
+    MultiClanFilter: ('abs_clan_map', 'clan_id'),
+    MultiCreedFilter: ('abs_creed_map', 'creed_id'),
+    MultiKeywordFilter: ('abs_keyword_map', 'keyword_id'),
+}
+
+
+class CardIndex(object):
+    """Maps each value of the list filters to the set of abstract card
+       ids with that value.
+
+       Filters built from the indexed filters, combined with and, or and
+       not, are answered with set operations. If a SearchIndex is given,
+       it is used for the card name and text filters. Other filters are
+       run against the database, but only to fetch the matching ids."""
+
+    def __init__(self, oSearchIndex=None):
+        self._oSearchIndex = oSearchIndex
+        self._dCards = {}
+        self._aAllIds = frozenset()
+        self._dIndex = {}
+        self._oGeneration = None
+        self._oLock = threading.Lock()
+
+    def build(self):
+        """(Re)build the index from the database"""
+        with self._oLock:
+            self._build()
+
+    def _build(self):
+        """Do the actual work of building the index.
+
+           Must be called with the lock held."""
+        oConn = AbstractCard._connection
+        dCards = {}
+        for oCard in AbstractCard.select():
+            dCards[oCard.id] = oCard
+        dIndex = {}
+        for sTable, sColumn in INDEXED_FILTERS.values():
+            dValues = {}
+            for iCardId, iValueId in oConn.queryAll(
+                    'SELECT abstract_card_id, %s FROM %s' % (sColumn, sTable)):
+                dValues.setdefault(iValueId, set()).add(iCardId)
+            dIndex[sTable] = {iValueId: frozenset(aIds) for iValueId, aIds
+                              in dValues.items()}
+        self._dCards = dCards
+        self._aAllIds = frozenset(dCards)
+        self._dIndex = dIndex
+        self._oGeneration = get_db_generation()
+
+    def _check_current(self):
+        """Rebuild the index if the database has changed"""
+        with self._oLock:
+            if self._oGeneration != get_db_generation():
+                self._build()
+
+    def get_cards(self, oFilter):
+        """Return the list of cards matching the filter, sorted by id,
+           or None if the filter can't be handled on abstract cards."""
+        self._check_current()
+        aIds = self._get_ids(oFilter)
+        if aIds is None:
+            return None
+        return [self._dCards[x] for x in sorted(aIds) if x in self._dCards]
+
+    def get_card_ids(self, oFilter):
+        """Return the set of card ids matching the filter, or None
+           if the filter can't be handled on abstract cards."""
+        self._check_current()
+        return self._get_ids(oFilter)
+
+    # pylint: disable=protected-access
+    # We deliberately poke at the filter internals
+    def _get_ids(self, oFilter):
+        """Evaluate the filter against the index"""
+        if isinstance(oFilter, NotNullFilter):
+            return frozenset()
+        if isinstance(oFilter, NullFilter):
+            return self._aAllIds
+        if isinstance(oFilter, (FilterAndBox, FilterOrBox)):
+            aResults = []
+            for oSubFilter in oFilter:
+                aIds = self._get_ids(oSubFilter)
+                if aIds is None:
+                    return None
+                aResults.append(aIds)
+            if not aResults:
+                return self._aAllIds
+            if isinstance(oFilter, FilterAndBox):
+                return frozenset.intersection(*aResults)
+            return frozenset.union(*aResults)
+        if isinstance(oFilter, FilterNot):
+            aIds = self._get_ids(oFilter._FilterNot__oSubFilter)
+            if aIds is None:
+                return None
+            return self._aAllIds - aIds
+        if type(oFilter) in INDEXED_FILTERS:
+            sTable, _sColumn = INDEXED_FILTERS[type(oFilter)]
+            dValues = self._dIndex[sTable]
+            aIds = set()
+            for iValueId in oFilter._aIds:
+                aIds.update(dValues.get(iValueId, ()))
+            return frozenset(aIds)
+        if self._oSearchIndex:
+            aIds = self._oSearchIndex.get_ids(oFilter)
+            if aIds is not None:
+                return aIds
+        if 'AbstractCard' not in oFilter.types:
+            return None
+        # Fall back to the database for this part of the filter
+        oConn = AbstractCard._connection
+        oQuery = Select(AbstractCard.q.id, where=oFilter._get_expression(),
+                        join=oFilter._get_joins(), distinct=True)
+        return frozenset(x[0] for x in oConn.queryAll(oConn.sqlrepr(oQuery)))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Pool of read-only database connections for multi-threaded servers.
+
+   The web app shares a single SQLObject connection, so SQLObject's and
+   Sutekh's caches are shared between threads. The pool sits underneath
+   it, handing each request its own DB-API connection for as long as the
+   request runs."""
+
+import threading
+import time
+
+from sutekh.base.core.BaseTables import AbstractCard
+from sutekh.base.core.CachedRelatedJoin import SOCachedRelatedJoin
+from sutekh.base.core.DBUtility import init_cache
+
+# Statements used to make a connection read-only, for the databases we
+# know about
+READ_ONLY_STATEMENTS = {
+    'sqlite': 'PRAGMA query_only = ON',
+    'postgres': 'SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY',
+    'mysql': 'SET SESSION TRANSACTION READ ONLY',
+}
+
+
+# Connections inherited from the parent process by forked workers. These
+# are kept, rather than closed, so the child doesn't disturb the parent's
+# use of them
+_aInherited = []
+
+
+def init_join_caches():
+    """Fill Sutekh's cached joins.
+
+       init_cache looks up the objects on both sides of each row of the
+       join tables one at a time, so the tables are loaded with a single
+       query each first, and the lookups are answered from SQLObject's
+       cache."""
+    aClasses = set()
+    for cCls in [AbstractCard] + AbstractCard.__subclasses__():
+        for oJoin in cCls.sqlmeta.joins:
+            if isinstance(oJoin, SOCachedRelatedJoin):
+                aClasses.update((oJoin.soClass, oJoin.otherClass))
+    # Hold on to the objects until the caches are filled, so SQLObject
+    # can't expire them from its cache
+    aObjects = [list(cCls.select())
+                for cCls in sorted(aClasses, key=lambda x: x.__name__)]
+    init_cache()
+    del aObjects
+
+
+def forget_connections(oConn):
+    """Stop the SQLObject connection using any of its existing DB-API
+       connections, so a forked process opens its own."""
+    # pylint: disable=protected-access
+    # SQLObject has no public way to do this
+    if oConn._pool:
+        _aInherited.extend(oConn._pool)
+        oConn._pool = []
+    if getattr(oConn, '_threadPool', None):
+        _aInherited.extend(oConn._threadPool.values())
+        oConn._threadPool = {}
+        oConn._threadOrigination = {}
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free in time"""
+
+
+class ConnectionPool(object):
+    """A fixed size pool of read-only DB-API connections.
+
+       Once installed on an SQLObject connection, queries made by a
+       thread between bind() and unbind() all use the connection bound
+       to that thread. Queries from other threads are left to SQLObject
+       as usual."""
+
+    def __init__(self, oConn, iSize, fTimeout=30.0):
+        self._oConn = oConn
+        self.iSize = iSize
+        self.fTimeout = fTimeout
+        self._aFree = []
+        self._iOpen = 0
+        self._oCondition = threading.Condition()
+        self._oLocal = threading.local()
+        self._fOrigGet = None
+        self._fOrigRelease = None
+
+    @staticmethod
+    def can_pool(oConn):
+        """Can we pool connections to this database?"""
+        # Each connection to an in-memory database is a separate database
+        return getattr(oConn, 'filename', None) != ':memory:'
+
+    def install(self):
+        """Make the SQLObject connection use the bound connections"""
+        self._fOrigGet = self._oConn.getConnection
+        self._fOrigRelease = self._oConn.releaseConnection
+        self._oConn.getConnection = self._get_connection
+        self._oConn.releaseConnection = self._release_connection
+
+    def uninstall(self):
+        """Restore the SQLObject connection, and close all the pooled
+           connections"""
+        if self._fOrigGet:
+            self._oConn.getConnection = self._fOrigGet
+            self._oConn.releaseConnection = self._fOrigRelease
+            self._fOrigGet = None
+            self._fOrigRelease = None
+        with self._oCondition:
+            for oRaw in self._aFree:
+                oRaw.close()
+            self._iOpen -= len(self._aFree)
+            self._aFree = []
+
+    def after_fork(self):
+        """Reset the pool in a forked process.
+
+           The connections and locks belong to the parent, so the child
+           starts with an empty pool."""
+        _aInherited.extend(self._aFree)
+        self._aFree = []
+        self._iOpen = 0
+        self._oCondition = threading.Condition()
+        self._oLocal = threading.local()
+
+    def _make_connection(self):
+        """Open a new read-only connection"""
+        # pylint: disable=protected-access
+        # We need SQLObject's connection options
+        oConn = self._oConn
+        if oConn.dbName == 'sqlite':
+            # The pool ensures only one thread uses a connection at a
+            # time, but it can be a different thread for each request
+            dOptions = dict(oConn._connOptions)
+            dOptions['check_same_thread'] = False
+            oRaw = oConn.module.connect(oConn.filename, **dOptions)
+            oRaw.text_factory = str
+        else:
+            oRaw = oConn.makeConnection()
+        sReadOnly = READ_ONLY_STATEMENTS.get(oConn.dbName)
+        if sReadOnly:
+            oCursor = oRaw.cursor()
+            oCursor.execute(sReadOnly)
+            oCursor.close()
+        return oRaw
+
+    def acquire(self):
+        """Return a free connection, opening a new one if the pool isn't
+           full, or waiting for one to be released if it is."""
+        fDeadline = time.monotonic() + self.fTimeout
+        with self._oCondition:
+            while not self._aFree and self._iOpen >= self.iSize:
+                fWait = fDeadline - time.monotonic()
+                if fWait <= 0:
+                    raise PoolTimeout('No database connection available')
+                self._oCondition.wait(fWait)
+            if self._aFree:
+                return self._aFree.pop()
+            self._iOpen += 1
+        try:
+            return self._make_connection()
+        except self._oConn.module.Error:
+            with self._oCondition:
+                self._iOpen -= 1
+                self._oCondition.notify()
+            raise
+
+    def release(self, oRaw):
+        """Return a connection to the pool"""
+        try:
+            # End any transaction the queries started, so the next
+            # request sees the current state of the database
+            oRaw.rollback()
+        except self._oConn.module.Error:
+            # The connection is broken, so drop it
+            with self._oCondition:
+                self._iOpen -= 1
+                self._oCondition.notify()
+            return
+        with self._oCondition:
+            self._aFree.append(oRaw)
+            self._oCondition.notify()
+
+    def bind(self):
+        """Bind a connection to the current thread.
+
+           The connection is only taken from the pool when the first
+           query is made."""
+        self._oLocal.bBound = True
+
+    def unbind(self):
+        """Release the current thread's connection back to the pool"""
+        self._oLocal.bBound = False
+        oRaw = getattr(self._oLocal, 'oRaw', None)
+        if oRaw is not None:
+            self._oLocal.oRaw = None
+            self.release(oRaw)
+
+    def _get_connection(self):
+        """Replacement for the SQLObject connection's getConnection"""
+        if not getattr(self._oLocal, 'bBound', False):
+            return self._fOrigGet()
+        oRaw = getattr(self._oLocal, 'oRaw', None)
+        if oRaw is None:
+            oRaw = self._oLocal.oRaw = self.acquire()
+        return oRaw
+
+    def _release_connection(self, oRaw, explicit=False):
+        """Replacement for the SQLObject connection's releaseConnection.
+
+           Bound connections are kept until unbind is called."""
+        if oRaw is getattr(self._oLocal, 'oRaw', None):
+            return
+        self._fOrigRelease(oRaw, explicit)
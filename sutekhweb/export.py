@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Export card sets as Sutekh XML files, in chunks suitable for
+   streaming to the client."""
+
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import Element, tostring
+
+from sqlobject import sqlhub
+
+from sutekh.base.core.BaseTables import PhysicalCardSet
+from sutekh.base.core.CardSetHolder import CardSetWrapper
+from sutekh.base.Utility import pretty_xml, norm_xml_quotes
+from sutekh.io.PhysicalCardSetWriter import PhysicalCardSetWriter
+
+# Number of card elements to serialise into each chunk
+XML_CHUNK_CARDS = 200
+
+
+def iter_card_set_xml(oCS, iChunkCards=XML_CHUNK_CARDS):
+    """Return an iterator over the card set as encoded chunks of
+       Sutekh XML.
+
+       The output is the same as PhysicalCardSetWriter.write, but the
+       document is never held in memory as a single string. The database
+       is read up front, so errors are raised here rather than part way
+       through the response."""
+    oWriter = PhysicalCardSetWriter()
+    # pylint: disable=protected-access
+    # We need the tree, rather than the written file
+    oRoot = oWriter._gen_tree(CardSetWrapper(oCS))
+    pretty_xml(oRoot)
+    return _serialise_chunks(oRoot, iChunkCards)
+
+
+def _serialise_chunks(oRoot, iChunkCards):
+    """Serialise the tree, iChunkCards child elements at a time"""
+    # Serialise the root element without its children, and split it
+    # into the start and end tags
+    oShell = Element(oRoot.tag, oRoot.attrib)
+    oShell.text = oRoot.text
+    sShell = norm_xml_quotes(tostring(oShell))
+    sEndTag = b'</' + oRoot.tag.encode('ascii') + b'>'
+    yield sShell[:-len(sEndTag)]
+    aChunk = []
+    for oElement in oRoot:
+        aChunk.append(norm_xml_quotes(tostring(oElement)))
+        if len(aChunk) >= iChunkCards:
+            yield b''.join(aChunk)
+            aChunk = []
+    aChunk.append(sEndTag)
+    yield b''.join(aChunk)
+
+
+def gzip_chunks(oChunks, iLevel=6):
+    """Compress the chunks with gzip as they are generated"""
+    # wbits of 16 + MAX_WBITS gives gzip, rather than zlib, framing
+    oCompressor = zlib.compressobj(iLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for sChunk in oChunks:
+        sData = oCompressor.compress(sChunk)
+        if sData:
+            yield sData
+    yield oCompressor.flush()
+
+
+class _ZipStream(object):
+    """Write-only file object which collects the data written to it, so
+       a zip file can be sent to the client as it is built.
+
+       It has no seek method, so zipfile writes the archive
+       sequentially."""
+
+    def __init__(self):
+        self._aData = []
+        self._iPos = 0
+
+    def write(self, sData):
+        """Add the data to the buffer"""
+        self._aData.append(bytes(sData))
+        self._iPos += len(sData)
+        return len(sData)
+
+    def tell(self):
+        """Return the number of bytes written so far"""
+        return self._iPos
+
+    def flush(self):
+        """Nothing to do - the data is sent by get_data"""
+
+    def get_data(self):
+        """Return, and clear, the data written since the last call"""
+        sData = b''.join(self._aData)
+        self._aData = []
+        return sData
+
+
+def _can_use_workers(oConn):
+    """Can worker threads open their own connections to this database?"""
+    return getattr(oConn, 'filename', None) != ':memory:'
+
+
+def _card_set_xml(iId):
+    """Return the XML for the card set with the given id.
+
+       This uses the calling thread's database connection."""
+    return b''.join(iter_card_set_xml(PhysicalCardSet.get(iId)))
+
+
+def iter_card_sets_zip(aCardSets, iWorkers):
+    """Return an iterator over a zip archive of the given card sets.
+
+       aCardSets is a list of (card set id, file name) pairs. The card
+       sets are written on a pool of iWorkers threads, each with its own
+       database connection, and are added to the archive in order."""
+    oConn = sqlhub.getConnection()
+    if iWorkers > 1 and len(aCardSets) > 1 and _can_use_workers(oConn):
+        return _zip_chunks(aCardSets, iWorkers, oConn)
+    return _zip_chunks(aCardSets, 0, oConn)
+
+
+def _zip_chunks(aCardSets, iWorkers, oConn):
+    """Build the zip file, yielding the data as each card set is added"""
+    oStream = _ZipStream()
+    oZip = zipfile.ZipFile(oStream, 'w', zipfile.ZIP_DEFLATED)
+    if not iWorkers:
+        for iId, sFileName in aCardSets:
+            oZip.writestr(sFileName, _card_set_xml(iId))
+            yield oStream.get_data()
+        oZip.close()
+        yield oStream.get_data()
+        return
+    aConnections = []
+    oLock = threading.Lock()
+
+    def _init_worker():
+        """Give the worker its own database connection"""
+        oWorkerConn = type(oConn).connectionFromURI(oConn.uri())
+        with oLock:
+            aConnections.append(oWorkerConn)
+        sqlhub.threadConnection = oWorkerConn
+
+    oPool = ThreadPoolExecutor(iWorkers, initializer=_init_worker)
+    try:
+        # Only keep a few card sets in flight, so memory use is bounded
+        # by the number of workers, not the size of the export
+        iWindow = 2 * iWorkers
+        aPending = []
+        aQueue = list(aCardSets)
+        aQueue.reverse()
+        while aQueue or aPending:
+            while aQueue and len(aPending) < iWindow:
+                iId, sFileName = aQueue.pop()
+                aPending.append((oPool.submit(_card_set_xml, iId),
+                                 sFileName))
+            oFuture, sFileName = aPending.pop(0)
+            oZip.writestr(sFileName, oFuture.result())
+            yield oStream.get_data()
+        oZip.close()
+        yield oStream.get_data()
+    finally:
+        oPool.shutdown(wait=True, cancel_futures=True)
+        for oWorkerConn in aConnections:
+            oWorkerConn.close()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Group a list of cards by any of the allowed groupings, without going
+   back to the database or sorting the cards again."""
+
+
+def get_key_function(cGrouping, fGetCard):
+    """Return the function the grouping uses to map an item to its
+       group keys"""
+    # pylint: disable=protected-access
+    # We deliberately poke at the grouping internals, so we use exactly
+    # the same keys as the grouping would
+    return cGrouping([], fGetCard)._IterGrouping__fKeys
+
+
+def sort_key(sName):
+    """The key used to sort the cards by name.
+
+       This matches jinja's sort filter, which ignores case."""
+    return sName.lower()
+
+
+class GroupedCards(object):
+    """A list of cards, sorted by name, with the group keys of each card
+       precomputed for each of the given groupings.
+
+       dGroupings maps grouping names to grouping classes. fGetCard
+       maps the items to their abstract cards, as for the groupings.
+       Grouping the cards only needs to put them in the right buckets,
+       and the cards stay sorted by name in each group.
+
+       If fMakeRow is given, it's used to build the rows the templates
+       display for each item, which are grouped in the same way."""
+
+    def __init__(self, aItems, dGroupings, fGetCard=lambda x: x,
+                 fMakeRow=None):
+        self.aItems = sorted(aItems, key=lambda x: sort_key(fGetCard(x).name))
+        self.aRows = self.aItems
+        if fMakeRow:
+            self.aRows = [fMakeRow(x) for x in self.aItems]
+        self._dKeys = {}
+        for sName, cGrouping in dGroupings.items():
+            fKeys = get_key_function(cGrouping, fGetCard)
+            self._dKeys[sName] = [set(fKeys(x)) for x in self.aItems]
+        self._dGrouped = {}
+
+    def __len__(self):
+        return len(self.aItems)
+
+    def group(self, sName, bRows=False):
+        """Return the list of (group, items) pairs for the named grouping,
+           in the same order as the grouping would give them.
+
+           If bRows is set, the groups contain the display rows rather
+           than the items."""
+        aGrouped = self._dGrouped.get((sName, bRows))
+        if aGrouped is None:
+            aGrouped = self._dGrouped[(sName, bRows)] = self._bucket(
+                self.aRows if bRows else self.aItems, self._dKeys[sName])
+        return aGrouped
+
+    @staticmethod
+    def _bucket(aItems, aKeys):
+        """Put the items into the groups given by aKeys"""
+        dGroups = {}
+        for oItem, aItemKeys in zip(aItems, aKeys):
+            if aItemKeys:
+                for oKey in aItemKeys:
+                    dGroups.setdefault(oKey, []).append(oItem)
+            else:
+                dGroups.setdefault(None, []).append(oItem)
+        return [(oKey, dGroups[oKey]) for oKey in
+                sorted(dGroups, key=lambda x: x if x else "")]
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Optional request instrumentation for the web app.
+
+   Records the time spent in each route, the database queries and
+   template rendering it did, and the number of rows it handled, and
+   reports them in the Prometheus text format."""
+
+import os
+import threading
+import time
+
+# Upper bounds (in seconds) of the request time histogram buckets
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                10.0)
+
+# The stats for the request being handled by this thread
+_oCurrent = threading.local()
+# Only one profiler can be active at a time, so we only profile
+# one request at a time
+_oProfileLock = threading.Lock()
+
+
+class RequestStats(object):
+    """The measurements for a single request"""
+
+    def __init__(self, sRoute):
+        self.sRoute = sRoute
+        self.fStart = time.perf_counter()
+        self.iQueries = 0
+        self.fQueryTime = 0.0
+        self.fTemplateTime = 0.0
+        self.dRows = {}
+        self.oProfiler = None
+        # Set while a streamed response is still being generated
+        self.bStreaming = False
+
+    def start_profile(self):
+        """Profile the rest of the request, unless another request
+           is already being profiled"""
+        if not _oProfileLock.acquire(False):
+            return
+        # Profiling is rarely enabled, so only import it when needed
+        import cProfile
+        self.oProfiler = cProfile.Profile()
+        try:
+            self.oProfiler.enable()
+        except ValueError:
+            # Some other profiler is active
+            self.oProfiler = None
+            _oProfileLock.release()
+
+    def stop_profile(self):
+        """Stop the profiler, if it's running"""
+        if self.oProfiler:
+            self.oProfiler.disable()
+            _oProfileLock.release()
+
+    def dump_profile(self, sDir):
+        """Write the profile data to a file in sDir, and return the
+           file name"""
+        if not self.oProfiler:
+            return None
+        sFileName = os.path.join(sDir, 'sutekhweb-%s-%d.prof' % (
+            self.sRoute, time.time() * 1000))
+        self.oProfiler.dump_stats(sFileName)
+        return sFileName
+
+
+class StartupTimer(object):
+    """Time the steps of starting the web app"""
+
+    def __init__(self):
+        self.fStart = self._fLast = time.perf_counter()
+        self.aSteps = []
+
+    def step(self, sStep):
+        """Record the time taken since the last step"""
+        fNow = time.perf_counter()
+        self.aSteps.append((sStep, fNow - self._fLast))
+        self._fLast = fNow
+
+    total = property(fget=lambda self: self._fLast - self.fStart)
+
+
+class MetricsRegistry(object):
+    """Collect the per route totals, and the startup times"""
+
+    def __init__(self):
+        self._oLock = threading.Lock()
+        self._dRoutes = {}
+        self._aStartup = []
+
+    def set_startup(self, aSteps):
+        """Set the (step, time) pairs for starting the web app"""
+        with self._oLock:
+            self._aStartup = list(aSteps)
+
+    def record(self, oStats, fElapsed):
+        """Add the measurements from a finished request"""
+        with self._oLock:
+            dRoute = self._dRoutes.setdefault(oStats.sRoute, {
+                'count': 0,
+                'time': 0.0,
+                'buckets': [0] * len(TIME_BUCKETS),
+                'queries': 0,
+                'query_time': 0.0,
+                'template_time': 0.0,
+                'rows': {},
+            })
+            dRoute['count'] += 1
+            dRoute['time'] += fElapsed
+            for iPos, fBound in enumerate(TIME_BUCKETS):
+                if fElapsed <= fBound:
+                    dRoute['buckets'][iPos] += 1
+            dRoute['queries'] += oStats.iQueries
+            dRoute['query_time'] += oStats.fQueryTime
+            dRoute['template_time'] += oStats.fTemplateTime
+            for sKind, iCount in oStats.dRows.items():
+                dRoute['rows'][sKind] = dRoute['rows'].get(sKind, 0) + iCount
+
+    def get_totals(self, sRoute):
+        """Return a copy of the totals for the given route, or None if
+           there aren't any"""
+        with self._oLock:
+            dRoute = self._dRoutes.get(sRoute)
+            if dRoute is None:
+                return None
+            dCopy = dict(dRoute)
+            dCopy['buckets'] = list(dRoute['buckets'])
+            dCopy['rows'] = dict(dRoute['rows'])
+            return dCopy
+
+    def clear(self):
+        """Reset all the totals"""
+        with self._oLock:
+            self._dRoutes.clear()
+
+    def render(self):
+        """Return the collected metrics in the Prometheus text format"""
+        with self._oLock:
+            aRoutes = sorted(self._dRoutes.items())
+            aLines = [
+                '# HELP sutekhweb_request_duration_seconds Time spent'
+                ' handling requests.',
+                '# TYPE sutekhweb_request_duration_seconds histogram',
+            ]
+            for sRoute, dRoute in aRoutes:
+                sLabel = 'route="%s"' % sRoute
+                for fBound, iCount in zip(TIME_BUCKETS, dRoute['buckets']):
+                    aLines.append('sutekhweb_request_duration_seconds_bucket'
+                                  '{%s,le="%s"} %d' % (sLabel, fBound,
+                                                       iCount))
+                aLines.append('sutekhweb_request_duration_seconds_bucket'
+                              '{%s,le="+Inf"} %d' % (sLabel, dRoute['count']))
+                aLines.append('sutekhweb_request_duration_seconds_sum{%s} %f'
+                              % (sLabel, dRoute['time']))
+                aLines.append('sutekhweb_request_duration_seconds_count{%s} %d'
+                              % (sLabel, dRoute['count']))
+            for sName, sKey, sHelp in [
+                    ('sutekhweb_sql_queries_total', 'queries',
+                     'Database queries issued.'),
+                    ('sutekhweb_sql_seconds_total', 'query_time',
+                     'Time spent in database queries.'),
+                    ('sutekhweb_template_seconds_total', 'template_time',
+                     'Time spent rendering templates.')]:
+                aLines.append('# HELP %s %s' % (sName, sHelp))
+                aLines.append('# TYPE %s counter' % sName)
+                for sRoute, dRoute in aRoutes:
+                    aLines.append('%s{route="%s"} %s' % (sName, sRoute,
+                                                         dRoute[sKey]))
+            aLines.append('# HELP sutekhweb_startup_seconds Time spent on'
+                          ' each step of starting the app.')
+            aLines.append('# TYPE sutekhweb_startup_seconds gauge')
+            for sStep, fTime in self._aStartup:
+                aLines.append('sutekhweb_startup_seconds{step="%s"} %f'
+                              % (sStep, fTime))
+            aLines.append('# HELP sutekhweb_rows_total Rows handled, such as'
+                          ' cards grouped or card set tree nodes built.')
+            aLines.append('# TYPE sutekhweb_rows_total counter')
+            for sRoute, dRoute in aRoutes:
+                for sKind, iCount in sorted(dRoute['rows'].items()):
+                    aLines.append('sutekhweb_rows_total{route="%s",kind="%s"}'
+                                  ' %d' % (sRoute, sKind, iCount))
+        return '\n'.join(aLines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+def start_request(sRoute):
+    """Start collecting stats for the current request"""
+    _oCurrent.oStats = RequestStats(sRoute)
+    return _oCurrent.oStats
+
+
+def get_current():
+    """Return the stats for the current request, or None if we aren't
+       collecting any"""
+    return getattr(_oCurrent, 'oStats', None)
+
+
+def end_request():
+    """Finish the current request and record its stats.
+
+       Returns the stats and the elapsed time, or (None, None) if no
+       stats were being collected. Requests with a streamed response
+       aren't finished until the stream is done."""
+    oStats = get_current()
+    if oStats is None or oStats.bStreaming:
+        return None, None
+    _oCurrent.oStats = None
+    oStats.stop_profile()
+    fElapsed = time.perf_counter() - oStats.fStart
+    REGISTRY.record(oStats, fElapsed)
+    return oStats, fElapsed
+
+
+def add_rows(sKind, iCount):
+    """Note that the current request handled iCount rows of the
+       given kind"""
+    oStats = get_current()
+    if oStats is not None:
+        oStats.dRows[sKind] = oStats.dRows.get(sKind, 0) + iCount
+
+
+def add_template_time(fTime):
+    """Add time spent rendering templates to the current request"""
+    oStats = get_current()
+    if oStats is not None:
+        oStats.fTemplateTime += fTime
+
+
+def time_iterator(oIter):
+    """Wrap a streamed template, so the time spent generating it is
+       counted as template time"""
+    oStats = get_current()
+    if oStats is None:
+        return oIter
+    # Flag this now, since the request is torn down before the
+    # stream starts
+    oStats.bStreaming = True
+    return _time_stream(oStats, oIter)
+
+
+def _time_stream(oStats, oIter):
+    """Generator which times each chunk of the stream"""
+    oIter = iter(oIter)
+    try:
+        while True:
+            fStart = time.perf_counter()
+            try:
+                sChunk = next(oIter)
+            except StopIteration:
+                return
+            finally:
+                oStats.fTemplateTime += time.perf_counter() - fStart
+            yield sChunk
+    finally:
+        oStats.bStreaming = False
+
+
+def instrument_connection(oConn):
+    """Count the queries run on connections of this type.
+
+       This is a no-op if the connection class has already been
+       instrumented."""
+    cConn = type(oConn)
+    if getattr(cConn, '_sutekhweb_instrumented', False):
+        return
+    fOrigExecute = cConn._executeRetry
+
+    def _executeRetry(self, oDBConn, oCursor, sQuery):
+        """Time the query"""
+        oStats = get_current()
+        if oStats is None:
+            return fOrigExecute(self, oDBConn, oCursor, sQuery)
+        fStart = time.perf_counter()
+        try:
+            return fOrigExecute(self, oDBConn, oCursor, sQuery)
+        finally:
+            oStats.iQueries += 1
+            oStats.fQueryTime += time.perf_counter() - fStart
+
+    cConn._executeRetry = _executeRetry
+    cConn._sutekhweb_instrumented = True
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""In-memory index of card names and card text, used for the simple
+   search and search suggestions."""
+
+import heapq
+import re
+import threading
+from bisect import bisect_left
+
+from sutekh.base.core.BaseTables import AbstractCard
+from sutekh.base.core.BaseFilters import CardNameFilter
+from sutekh.core.Filters import CardTextFilter
+from sutekh.core.SutekhTables import SutekhAbstractCard
+
+from sutekhweb.cache import get_db_generation
+
+WORD_RE = re.compile(r'\w+')
+
+# How suggestions matched the query, best first
+MATCH_EXACT = 'exact'
+MATCH_PREFIX = 'prefix'
+MATCH_WORD = 'word'
+MATCH_NAME = 'name'
+MATCH_TEXT = 'text'
+
+
+def _iter_sorted_prefix(aSorted, sPrefix):
+    """Iterate over the entries of the sorted list of (key, value) pairs
+       whose keys start with sPrefix"""
+    iPos = bisect_left(aSorted, (sPrefix,))
+    while iPos < len(aSorted) and aSorted[iPos][0].startswith(sPrefix):
+        yield aSorted[iPos]
+        iPos += 1
+
+
+class SearchIndex(object):
+    """Index of the card names and text.
+
+       Names are kept in sorted lists for prefix lookups, and the card
+       text in an inverted index of the words it contains. Matches from
+       the inverted index are checked against the full text, so the
+       results are the same as the CardName and CardText filters."""
+
+    def __init__(self):
+        self._dNames = {}
+        self._dCanonical = {}
+        self._aNames = []
+        self._aNameWords = []
+        self._dTexts = {}
+        self._dWords = {}
+        self._aWords = []
+        self._aReversedWords = []
+        self._oGeneration = None
+        self._oLock = threading.Lock()
+
+    def build(self):
+        """(Re)build the index from the database"""
+        with self._oLock:
+            self._build()
+
+    def _build(self):
+        """Do the actual work of building the index.
+
+           Must be called with the lock held."""
+        # pylint: disable=protected-access
+        # we need the connection to run the queries
+        oConn = AbstractCard._connection
+        dNames = {}
+        dCanonical = {}
+        aNames = []
+        aNameWords = []
+        for iId, sCanonical, sName in oConn.queryAll(
+                'SELECT id, canonical_name, name FROM %s'
+                % AbstractCard.sqlmeta.table):
+            dNames[iId] = sName
+            dCanonical[iId] = sCanonical
+            aNames.append((sCanonical, iId))
+            for sWord in set(WORD_RE.findall(sCanonical)):
+                aNameWords.append((sWord, iId))
+        dTexts = {}
+        dWords = {}
+        for iId, sText in oConn.queryAll(
+                'SELECT id, search_text FROM %s'
+                % SutekhAbstractCard.sqlmeta.table):
+            sText = (sText or '').lower()
+            dTexts[iId] = sText
+            for sWord in set(WORD_RE.findall(sText)):
+                dWords.setdefault(sWord, set()).add(iId)
+        self._dNames = dNames
+        self._dCanonical = dCanonical
+        self._aNames = sorted(aNames)
+        self._aNameWords = sorted(aNameWords)
+        self._dTexts = dTexts
+        self._dWords = {sWord: frozenset(aIds) for sWord, aIds
+                        in dWords.items()}
+        self._aWords = sorted(dWords)
+        self._aReversedWords = sorted(x[::-1] for x in dWords)
+        self._oGeneration = get_db_generation()
+
+    def _check_current(self):
+        """Rebuild the index if the database has changed"""
+        with self._oLock:
+            if self._oGeneration != get_db_generation():
+                self._build()
+
+    def get_name(self, iId):
+        """Return the name of the card with the given id"""
+        return self._dNames.get(iId)
+
+    def find_names(self, sPattern):
+        """Return the ids of the cards whose names contain sPattern"""
+        self._check_current()
+        sPattern = sPattern.lower()
+        return frozenset(iId for sName, iId in self._aNames
+                         if sPattern in sName)
+
+    def find_text(self, sPattern):
+        """Return the ids of the cards whose text contains sPattern"""
+        self._check_current()
+        sPattern = sPattern.lower()
+        aCandidates = None
+        for oMatch in WORD_RE.finditer(sPattern):
+            aIds = self._find_word(
+                oMatch.group(), oMatch.start() > 0,
+                oMatch.end() < len(sPattern))
+            if aCandidates is None:
+                aCandidates = aIds
+            else:
+                aCandidates = aCandidates & aIds
+            if not aCandidates:
+                return frozenset()
+        if aCandidates is None:
+            # No words to use, so we check all the cards
+            aCandidates = self._dTexts
+        return frozenset(iId for iId in aCandidates
+                         if sPattern in self._dTexts[iId])
+
+    def _find_word(self, sWord, bStart, bEnd):
+        """Return the ids of the cards containing a word which could
+           match sWord.
+
+           bStart and bEnd are set if sWord is known to be the start or
+           end of a word, respectively."""
+        if bStart and bEnd:
+            return self._dWords.get(sWord, frozenset())
+        if bStart:
+            aWords = self._prefix_words(self._aWords, sWord)
+        elif bEnd:
+            aWords = [x[::-1] for x in
+                      self._prefix_words(self._aReversedWords, sWord[::-1])]
+        else:
+            aWords = [x for x in self._aWords if sWord in x]
+        aIds = set()
+        for sMatch in aWords:
+            aIds.update(self._dWords[sMatch])
+        return aIds
+
+    @staticmethod
+    def _prefix_words(aSorted, sPrefix):
+        """Return the words in the sorted list starting with sPrefix"""
+        iPos = bisect_left(aSorted, sPrefix)
+        aResult = []
+        while iPos < len(aSorted) and aSorted[iPos].startswith(sPrefix):
+            aResult.append(aSorted[iPos])
+            iPos += 1
+        return aResult
+
+    def get_ids(self, oFilter):
+        """Return the ids of the cards matching a CardName or CardText
+           filter, or None if the filter can't be answered from the index.
+
+           Patterns using the % and _ wildcards, or card text searches
+           including braces, are left to the database."""
+        # pylint: disable=protected-access
+        # We deliberately poke at the filter internals
+        if type(oFilter) is CardNameFilter:
+            sPattern = oFilter._CardNameFilter__sPattern
+            if '%' in sPattern or '_' in sPattern:
+                return None
+            return self.find_names(sPattern)
+        if type(oFilter) is CardTextFilter:
+            sPattern = oFilter._sPattern
+            if '%' in sPattern or '_' in sPattern or oFilter._bBraces:
+                return None
+            return self.find_text(sPattern)
+        return None
+
+    def suggest(self, sQuery, iLimit):
+        """Return up to iLimit (card id, match type) pairs for the cards
+           best matching sQuery.
+
+           Cards whose names match are listed first: exact matches, then
+           names starting with the query, names with a word starting with
+           the query and names containing the query. These are followed
+           by cards whose text matches."""
+        self._check_current()
+        sQuery = sQuery.strip().lower()
+        aResults = []
+        if not sQuery or iLimit <= 0:
+            return aResults
+        aSeen = set()
+
+        def _add(aIds, sMatch, bSorted=False):
+            """Add the ids, in name order, until we have enough"""
+            if not bSorted:
+                # We only need the first few, so avoid sorting them all
+                aIds = heapq.nsmallest(iLimit + len(aSeen), set(aIds),
+                                       key=self._dCanonical.get)
+            for iId in aIds:
+                if iId not in aSeen:
+                    aSeen.add(iId)
+                    aResults.append((iId, sMatch))
+                    if len(aResults) >= iLimit:
+                        return True
+            return False
+
+        # The names are already sorted, so we can stop as soon as we
+        # have enough
+        aExact = []
+        for sName, iId in _iter_sorted_prefix(self._aNames, sQuery):
+            if sName != sQuery:
+                break
+            aExact.append(iId)
+        if _add(aExact, MATCH_EXACT, True):
+            return aResults
+        if _add((iId for _sName, iId in _iter_sorted_prefix(self._aNames,
+                                                             sQuery)),
+                MATCH_PREFIX, True):
+            return aResults
+        if _add([iId for _sWord, iId in _iter_sorted_prefix(
+                self._aNameWords, sQuery)], MATCH_WORD):
+            return aResults
+        if _add([iId for sName, iId in self._aNames if sQuery in sName],
+                MATCH_NAME):
+            return aResults
+        # Treat the last word of the query as a prefix, so suggestions
+        # work while the user is typing
+        aTextIds = None
+        aWords = WORD_RE.findall(sQuery)
+        for iPos, sWord in enumerate(aWords):
+            if iPos == len(aWords) - 1:
+                aIds = set()
+                for sMatch in self._prefix_words(self._aWords, sWord):
+                    aIds.update(self._dWords[sMatch])
+            else:
+                aIds = self._dWords.get(sWord, frozenset())
+            aTextIds = aIds if aTextIds is None else aTextIds & aIds
+            if not aTextIds:
+                break
+        if aTextIds:
+            _add(aTextIds, MATCH_TEXT)
+        return aResults
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Precomputed summaries of the contents of each card set.
+
+   A card set's summary is only rebuilt when its contents change, which
+   is detected from its rows in the physical card set mapping table."""
+
+import threading
+
+from sutekh.base.core.BaseTables import PhysicalCardSet
+from sutekh.core.SutekhTables import CRYPT_TYPES
+
+from sutekhweb.cache import get_db_generation
+
+# The columns used to detect changes to a card set's contents - adding
+# or removing cards changes the count, and replacing a card, or changing
+# its printing, changes the physical card ids. The ids are also summed
+# weighted by their row ids, so changes which keep the plain sum the same
+# are still caught. The cast stops the products overflowing in postgres
+SIGNATURE_QUERY = (
+    'SELECT physical_card_set_id, COUNT(*), SUM(physical_card_id), '
+    'SUM(CAST(id AS BIGINT) * physical_card_id), MAX(id) '
+    'FROM physical_map GROUP BY physical_card_set_id')
+
+CONTENTS_QUERY = (
+    'SELECT pm.physical_card_set_id, pc.id, pc.abstract_card_id, '
+    'pc.printing_id, COUNT(*) '
+    'FROM physical_map pm, physical_card pc '
+    'WHERE pm.physical_card_id = pc.id %s'
+    'GROUP BY pm.physical_card_set_id, pc.id, pc.abstract_card_id, '
+    'pc.printing_id')
+
+CRYPT_QUERY = (
+    "SELECT atm.abstract_card_id FROM abs_type_map atm, card_type ct "
+    "WHERE atm.card_type_id = ct.id AND ct.name IN (%s)" %
+    ', '.join("'%s'" % x for x in CRYPT_TYPES))
+
+
+class CardSetSummary(object):
+    """The contents of a card set.
+
+       aRows holds the (physical card id, abstract card id, printing id,
+       count) for each physical card in the set. dCards maps abstract card
+       ids to their counts, and dPrintings maps (abstract card id, printing
+       id) pairs to theirs."""
+
+    def __init__(self, aRows, aCryptIds):
+        self.aRows = aRows
+        self._aCryptIds = aCryptIds
+        self.dCards = {}
+        self.dPrintings = {}
+        self.iCrypt = 0
+        self.iLibrary = 0
+        for _iPhysId, iAbsId, iPrintId, iCount in aRows:
+            self.dCards[iAbsId] = self.dCards.get(iAbsId, 0) + iCount
+            tKey = (iAbsId, iPrintId)
+            self.dPrintings[tKey] = self.dPrintings.get(tKey, 0) + iCount
+            if iAbsId in aCryptIds:
+                self.iCrypt += iCount
+            else:
+                self.iLibrary += iCount
+        # Somewhere for the users of the summary to keep things derived
+        # from it, so they're discarded along with it. The entries also
+        # depend on the rest of the database, such as the card names, so
+        # they're stored with the database generation they were built for
+        self.dDerived = {}
+
+    total = property(fget=lambda self: self.iCrypt + self.iLibrary)
+
+    def get_derived(self, sKey):
+        """Return the derived value stored under sKey, or None if there
+           isn't one or the database has changed since it was built"""
+        tEntry = self.dDerived.get(sKey)
+        if tEntry is not None and tEntry[0] == get_db_generation():
+            return tEntry[1]
+        return None
+
+    def set_derived(self, sKey, oValue, oGeneration):
+        """Store a value derived from the summary under sKey.
+
+           oGeneration is the database generation from before the value
+           was built, so a change made while building it isn't missed."""
+        self.dDerived[sKey] = (oGeneration, oValue)
+
+    def get_counts(self, aRows=None):
+        """Return the crypt and library totals, either for the whole
+           card set, or for the given subset of aRows"""
+        if aRows is None:
+            return {'crypt': self.iCrypt, 'library': self.iLibrary}
+        dCounts = {'crypt': 0, 'library': 0}
+        for _iPhysId, iAbsId, _iPrintId, iCount in aRows:
+            if iAbsId in self._aCryptIds:
+                dCounts['crypt'] += iCount
+            else:
+                dCounts['library'] += iCount
+        return dCounts
+
+
+class CardSetSummaries(object):
+    """Cache of CardSetSummary objects for each card set.
+
+       When the database changes, the mapping table is checked with a
+       single query, and only the summaries of card sets whose contents
+       have changed are discarded."""
+
+    def __init__(self):
+        self._dSummaries = {}
+        self._dSignatures = {}
+        self._aCryptIds = frozenset()
+        self._oGeneration = None
+        self._oLock = threading.Lock()
+
+    def _check_current(self, oConn):
+        """Discard any out of date summaries.
+
+           Must be called with the lock held."""
+        oGeneration = get_db_generation()
+        if oGeneration == self._oGeneration:
+            return
+        aCryptIds = frozenset(x[0] for x in oConn.queryAll(CRYPT_QUERY))
+        if aCryptIds != self._aCryptIds:
+            # The card list has changed, so all the totals are suspect
+            self._dSummaries.clear()
+            self._aCryptIds = aCryptIds
+        dSignatures = {}
+        for oRow in oConn.queryAll(SIGNATURE_QUERY):
+            dSignatures[oRow[0]] = tuple(oRow[1:])
+        for iCSId, oSummary in list(self._dSummaries.items()):
+            if dSignatures.get(iCSId) != self._dSignatures.get(iCSId):
+                del self._dSummaries[iCSId]
+            else:
+                # The derived values are out of date anyway, so free them
+                oSummary.dDerived.clear()
+        self._dSignatures = dSignatures
+        self._oGeneration = oGeneration
+
+    def _load(self, oConn, aCSIds=None):
+        """Build the summaries for the given card set ids, or all the
+           card sets if aCSIds is None.
+
+           Must be called with the lock held."""
+        if aCSIds is None:
+            sWhere = ''
+        else:
+            sWhere = 'AND pm.physical_card_set_id IN (%s) ' % ', '.join(
+                str(int(x)) for x in aCSIds)
+        dRows = {}
+        for iCSId, iPhysId, iAbsId, iPrintId, iCount in oConn.queryAll(
+                CONTENTS_QUERY % sWhere):
+            dRows.setdefault(iCSId, []).append((iPhysId, iAbsId, iPrintId,
+                                                iCount))
+        if aCSIds is None:
+            aCSIds = [x[0] for x in oConn.queryAll(
+                'SELECT id FROM %s' % PhysicalCardSet.sqlmeta.table)]
+        for iCSId in aCSIds:
+            self._dSummaries[iCSId] = CardSetSummary(dRows.get(iCSId, []),
+                                                     self._aCryptIds)
+
+    def get(self, iCSId):
+        """Return the summary for the card set with the given id"""
+        return self.get_many([iCSId])[iCSId]
+
+    def get_many(self, aCSIds):
+        """Return a dictionary of the summaries for the given card set
+           ids, building any missing ones with a single query"""
+        # pylint: disable=protected-access
+        # we need the connection to run the queries
+        oConn = PhysicalCardSet._connection
+        with self._oLock:
+            self._check_current(oConn)
+            aMissing = [x for x in aCSIds if x not in self._dSummaries]
+            if aMissing:
+                self._load(oConn, aMissing)
+            return dict((x, self._dSummaries[x]) for x in aCSIds)
+
+    def get_all(self):
+        """Return a dictionary of the summaries for every card set"""
+        # pylint: disable=protected-access
+        # we need the connection to run the queries
+        oConn = PhysicalCardSet._connection
+        with self._oLock:
+            self._check_current(oConn)
+            aIds = [x[0] for x in oConn.queryAll(
+                'SELECT id FROM %s' % PhysicalCardSet.sqlmeta.table)]
+            aMissing = [x for x in aIds if x not in self._dSummaries]
+            if len(aMissing) > len(aIds) // 2:
+                # Cheaper to load everything at once
+                self._load(oConn)
+            elif aMissing:
+                self._load(oConn, aMissing)
+            return dict((x, self._dSummaries[x]) for x in aIds)
+
+    def clear(self):
+        """Discard all the summaries"""
+        with self._oLock:
+            self._dSummaries.clear()
+            self._oGeneration = None
@@ -6,30 +6,36 @@
 """The main web-app"""
 
 from flask import (Flask, render_template, request, url_for, redirect,
-                   send_file)
+                   Response, stream_with_context, jsonify,
+                   make_response, abort, g, before_render_template,
+                   template_rendered)
 app = Flask(__name__)
 
+import gc
 import os
+import hashlib
+import sys
+import tempfile
+import time
+from functools import wraps
 from urllib.parse import quote, unquote
-from io import StringIO, BytesIO
 
-from sqlobject import sqlhub, connectionForURI, SQLObjectNotFound
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import escape as escape_html
+from sqlobject import sqlhub, connectionForURI, SQLObjectNotFound, IN
 
-from sutekh.base.core.BaseTables import (AbstractCard,
+from sutekh.base.core.BaseTables import (AbstractCard, Printing,
+                                         PhysicalCardSet,
                                          MapPhysicalCardToPhysicalCardSet)
 from sutekh.base.core.BaseAdapters import (IAbstractCard, IPhysicalCardSet,
-                                           IKeyword, IPhysicalCard,
                                            IPrintingName)
 from sutekh.base.core.FilterParser import FilterParser, escape
-from sutekh.base.core.CardSetHolder import CardSetWrapper
-from sutekh.base.core.CardSetUtilities import find_children, has_children
 from sutekh.base.core.BaseFilters import (NullFilter, MultiCardTypeFilter,
                                           MultiKeywordFilter,
                                           PhysicalCardSetFilter, FilterAndBox)
 from sutekh.base.core.BaseGroupings import (MultiTypeGrouping,
                                             NullGrouping,
                                             CardTypeGrouping)
-from sutekh.base.core.DBUtility import init_cache
 from sutekh.base.Utility import sqlite_uri, prefs_dir, safe_filename
 
 from sutekh.core.Filters import (MultiClanFilter, MultiVirtueFilter,
@@ -39,7 +45,21 @@ from sutekh.core.Groupings import (ClanGrouping, GroupGrouping,
                                    CryptLibraryGrouping)
 from sutekh.SutekhUtility import is_crypt_card
 from sutekh.io.IconManager import IconManager
-from sutekh.io.PhysicalCardSetWriter import PhysicalCardSetWriter
+
+if __name__ == "__main__" and not __package__:
+    # When run as a script, the directory holding this file is first on
+    # the path, which hides the sutekhweb package, so use its parent
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from sutekhweb.cache import (ResultCache, get_db_generation, get_db_modified,
+                             can_detect_changes, start_request)
+from sutekhweb.cardindex import CardIndex
+from sutekhweb.searchindex import SearchIndex
+from sutekhweb.db import (ConnectionPool, init_join_caches,
+                          forget_connections)
+from sutekhweb.summary import CardSetSummaries
+from sutekhweb.grouping import GroupedCards
+from sutekhweb import metrics
 
 
 ALLOWED_GROUPINGS = {'No': NullGrouping,
@@ -76,10 +96,11 @@ class CardSetTree(object):
     """object used to build up card set trees for the jinja template"""
 
     __slots__ = ["name", "inuse", "linkname", "children", "info", "nodeid",
-                 "parent"]
+                 "parent", "counts"]
 
     def __init__(self, sName, bInUse, oParent, iId):
         self.name = sName
+        self.counts = None
         self.inuse = bInUse
         self.linkname = double_quote(sName.encode('utf8'))
         self.parent = ''
@@ -95,11 +116,8 @@ class PrintingCount(object):
 
     __slots__ = ['print_name', 'cnt']
 
-    def __init__(self, oPrinting):
-        if oPrinting:
-            self.print_name = IPrintingName(oPrinting)
-        else:
-            self.print_name = ' Unknown Expansion'
+    def __init__(self, sPrintName):
+        self.print_name = sPrintName
         self.cnt = 0
 
 
@@ -114,19 +132,136 @@ class CardCount(object):
         self.printings = {}
 
 
+class CardRow(object):
+    """Flattened details of a card for the card list and card set
+       templates, so rendering a row doesn't touch the database objects.
+
+       The strings are escaped when the row is created, rather than
+       each time it's rendered. printings is a tuple of (printing name,
+       count) pairs, sorted by name."""
+
+    __slots__ = ['name', 'link', 'cnt', 'printings']
+
+    def __init__(self, sName, iCount=0, aPrintings=()):
+        self.name = escape_html(sName)
+        self.link = escape_html('/card/%s' % sName)
+        self.cnt = iCount
+        self.printings = tuple((escape_html(sPrint), iPrintCount)
+                               for sPrint, iPrintCount in aPrintings)
+
+
+def make_card_row(oCard):
+    """Create the CardRow for an abstract card"""
+    return CardRow(oCard.name)
+
+
+def make_count_row(oCount):
+    """Create the CardRow for a CardCount"""
+    # Sorted in the same way as jinja's sort filter
+    aPrintings = tuple(sorted(
+        ((x.print_name, x.cnt) for x in oCount.printings.values()),
+        key=lambda x: x[0].lower()))
+    return CardRow(oCount.card.name, oCount.cnt, aPrintings)
+
+
+def get_card_set_counts(oCS, aCardIds=None, aPhysCardIds=None):
+    """Count the cards in the card set.
+
+       The contents come from the card set's precomputed summary, and the
+       abstract cards and printings are then loaded in bulk, so the number
+       of queries doesn't grow with the size of the card set. The results
+       for the whole card set are kept with the summary.
+
+       If aCardIds or aPhysCardIds are given, only the cards with
+       abstract card or physical card ids in the given sets are counted.
+
+       Returns a dictionary of CardCount objects, keyed by abstract card,
+       and a dictionary of crypt and library totals."""
+    oGeneration = get_db_generation()
+    oSummary = CARDSET_SUMMARIES.get(oCS.id)
+    bFiltered = aCardIds is not None or aPhysCardIds is not None
+    if not bFiltered:
+        oCached = oSummary.get_derived('counts')
+        if oCached is not None:
+            return oCached
+    aRows = oSummary.aRows
+    if aCardIds is not None:
+        aRows = [x for x in aRows if x[1] in aCardIds]
+    if aPhysCardIds is not None:
+        aRows = [x for x in aRows if x[0] in aPhysCardIds]
+    dAbsCards = {}
+    aAbsIds = list(set(x[1] for x in aRows))
+    if aAbsIds:
+        for oCard in AbstractCard.select(IN(AbstractCard.q.id, aAbsIds)):
+            dAbsCards[oCard.id] = oCard
+    dPrintings = {None: None}
+    # Look up the printing names once, rather than for each card
+    dPrintNames = {None: ' Unknown Expansion'}
+    aPrintIds = list(set(x[2] for x in aRows if x[2] is not None))
+    if aPrintIds:
+        for oPrinting in Printing.select(IN(Printing.q.id, aPrintIds)):
+            dPrintings[oPrinting.id] = oPrinting
+            dPrintNames[oPrinting.id] = IPrintingName(oPrinting)
+    dCards = {}
+    for _iPhysId, iAbsId, iPrintId, iCount in aRows:
+        oAbsCard = dAbsCards[iAbsId]
+        oPrinting = dPrintings[iPrintId]
+        oCount = dCards.get(oAbsCard)
+        if oCount is None:
+            oCount = dCards[oAbsCard] = CardCount(oAbsCard)
+        oCount.cnt += iCount
+        oPrintingCount = oCount.printings.get(oPrinting)
+        if oPrintingCount is None:
+            oPrintingCount = oCount.printings[oPrinting] = \
+                PrintingCount(dPrintNames[iPrintId])
+        oPrintingCount.cnt += iCount
+    if bFiltered:
+        return dCards, oSummary.get_counts(aRows)
+    oResult = (dCards, oSummary.get_counts())
+    oSummary.set_derived('counts', oResult, oGeneration)
+    return oResult
+
+
 class WebIconManager(IconManager):
-    """Handle icons for the web app"""
+    """Handle icons for the web app.
+
+       The icon urls, and the icons for each card, are cached, since
+       they are looked up for every card page view."""
+
+    # Keywords which have their own icons
+    ICON_KEYWORDS = ('burn option', 'advanced')
+
+    def __init__(self, sPath):
+        super().__init__(sPath)
+        self._dUrls = {}
+        self._oCardIcons = ResultCache(5000)
 
     def _get_icon(self, sFileName, _iSize=12):
         """Return the correct url for the icon"""
         if sFileName:
-            return url_for('static',
-                           filename='/'.join((self._sPrefsDir, sFileName)))
+            # The url depends on where the app is mounted
+            oKey = (sFileName, request.script_root)
+            sUrl = self._dUrls.get(oKey)
+            if sUrl is None:
+                sUrl = url_for('static',
+                               filename='/'.join((self._sPrefsDir,
+                                                  sFileName)))
+                self._dUrls[oKey] = sUrl
+            return sUrl
         return None
 
     def get_all_icons(self, oCard):
         """Returns a dictionarty of all the icons appropriate for
            the given card"""
+        oKey = (oCard.id, request.script_root)
+        dIcons = self._oCardIcons.get(oKey)
+        if dIcons is None:
+            dIcons = self._find_all_icons(oCard)
+            self._oCardIcons.set(oKey, dIcons)
+        return dIcons
+
+    def _find_all_icons(self, oCard):
+        """Look up all the icons for the card"""
         dIcons = {}
         if oCard.cardtype:
             dIcons.update(self._get_card_type_icons(oCard.cardtype))
@@ -138,15 +273,11 @@ class WebIconManager(IconManager):
             dIcons.update(self._get_discipline_icons(oCard.discipline))
         if oCard.virtue:
             dIcons.update(self._get_virtue_icons(oCard.virtue))
-        if oCard.virtue:
-            dIcons.update(self._get_virtue_icons(oCard.virtue))
         for oItem in oCard.keywords:
-            if oItem == IKeyword('burn option'):
-                dIcons.update({oItem.keyword:
-                               self.get_icon_by_name('burn option')})
-            elif oItem == IKeyword('advanced'):
+            # Comparing names avoids looking up the keywords each time
+            if oItem.keyword in self.ICON_KEYWORDS:
                 dIcons.update({oItem.keyword:
-                               self.get_icon_by_name('advanced')})
+                               self.get_icon_by_name(oItem.keyword)})
         dNewIcons = {}
         for sName, oIcon in dIcons.items():
             # Filter out any icons for which there is no filename
@@ -160,6 +291,27 @@ class WebIconManager(IconManager):
 ICON_MANAGER = WebIconManager('icons')
 # Likewise for the Filter Parser
 PARSER = FilterParser()
+# Grouped card lists, keyed by filter and grouping
+CARDLIST_CACHE = ResultCache(32)
+# Rendered card detail pages
+CARD_PAGE_CACHE = ResultCache(5000)
+# The script root the card pages were rendered for in advance, if they were
+CARD_PAGE_ROOT = None
+# The card set tree for /cardsets
+CARDSET_TREE_CACHE = ResultCache(1)
+# The values for the list filters on the filter page
+FILTER_VALUES_CACHE = ResultCache(1)
+# In-memory index of the card names and text, used for the name & text
+# filters and the search suggestions
+SEARCH_INDEX = SearchIndex()
+# In-memory index used to answer the list filters
+CARD_INDEX = CardIndex(SEARCH_INDEX)
+# The contents and totals of each card set
+CARDSET_SUMMARIES = CardSetSummaries()
+
+# Set up by create_app
+DB_POOL = None
+FORK_HANDLER_REGISTERED = False
 
 
 # default config
@@ -170,6 +322,343 @@ class DefConfig(object):
     SUTEKH_PREFS = prefs_dir("Sutekh")
     DATABASE_URI = sqlite_uri(os.path.join(SUTEKH_PREFS, "sutekh.db"))
     ICONS = False
+    # Number of filtered & grouped card lists to keep (0 disables caching)
+    CARDLIST_CACHE_SIZE = 32
+    # Answer card filters, including card name & text searches, from the
+    # in-memory indexes where possible
+    USE_CARD_INDEX = True
+    # Send the card list and card set pages as they are rendered
+    STREAM_TEMPLATES = True
+    # Number of template chunks to buffer before sending when streaming.
+    # Values of 1 or less send each chunk as soon as it's rendered
+    STREAM_BUFFER_SIZE = 64
+    # Only send the group headers of the card list and card set pages,
+    # and fetch the cards in each group when it's expanded
+    LAZY_GROUPS = False
+    # Compile all the templates at startup
+    PRECOMPILE_TEMPLATES = True
+    # Where to keep the compiled templates between runs (defaults to a
+    # directory in the system temp directory)
+    TEMPLATE_CACHE_DIR = None
+    # Send ETag & Last-Modified headers and answer conditional GETs
+    HTTP_CACHING = True
+    # max-age for the Cache-Control header. With 0, clients must
+    # revalidate with the server before reusing a page
+    HTTP_CACHE_MAX_AGE = 0
+    # How to fill the card page cache: 'lazy' caches pages as they are
+    # viewed, 'eager' renders every card at startup and 'off' disables it
+    CARD_PAGE_CACHE = 'lazy'
+    CARD_PAGE_CACHE_SIZE = 5000
+    # Collect per-route timings & query counts and serve them on /metrics
+    METRICS = False
+    # When collecting metrics, profile requests and save the profile of
+    # those that take longer than this many seconds (0 disables this)
+    PROFILE_SLOW_REQUESTS = 0
+    # Where to save the profiles (defaults to the system temp directory)
+    PROFILE_DIR = None
+    # gzip card set downloads for clients which accept it
+    GZIP_DOWNLOADS = True
+    # Number of threads used to write the card sets for a zip download
+    EXPORT_WORKERS = 4
+    # Maximum number of (read-only) database connections shared by the
+    # request threads (0 disables the pool)
+    DB_POOL_SIZE = 8
+    # Seconds a request waits for a free connection before failing
+    DB_POOL_TIMEOUT = 30
+
+
+def configure_caches():
+    """Resize the result caches, and update the config part of the ETags,
+       to match the app config"""
+    global CONFIG_TOKEN
+    CONFIG_TOKEN = repr(tuple(app.config[x] for x in RENDER_CONFIG))
+    CARDLIST_CACHE.resize(app.config['CARDLIST_CACHE_SIZE'])
+    if app.config['CARD_PAGE_CACHE'] == 'off':
+        CARD_PAGE_CACHE.resize(0)
+    else:
+        CARD_PAGE_CACHE.resize(app.config['CARD_PAGE_CACHE_SIZE'])
+
+
+def precompile_templates():
+    """Compile all the templates, so requests never need to.
+
+       The compiled templates are also kept in a bytecode cache, so
+       later starts don't need to compile them again."""
+    oEnv = app.jinja_env
+    if oEnv.bytecode_cache is None:
+        oEnv.bytecode_cache = FileSystemBytecodeCache(
+            app.config['TEMPLATE_CACHE_DIR'])
+    for sName in oEnv.list_templates(extensions=['html']):
+        oEnv.get_template(sName)
+
+
+def render_large_template(sTemplate, **dContext):
+    """Render a template that may produce a very large page.
+
+       If STREAM_TEMPLATES is set, the page is sent to the client as it is
+       generated, rather than built up in memory first."""
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(sTemplate, **dContext)
+    app.update_template_context(dContext)
+    oStream = app.jinja_env.get_template(sTemplate).stream(dContext)
+    # jinja refuses buffer sizes below 2, which we treat as no buffering
+    if app.config['STREAM_BUFFER_SIZE'] > 1:
+        oStream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])
+    if app.config['METRICS']:
+        oStream = metrics.time_iterator(oStream)
+    return Response(stream_with_context(oStream))
+
+
+def download_response(oChunks, sFileName,
+                      sMimeType="application/octet-stream", bGzip=True):
+    """Return a response which streams the chunks to the client as
+       the named attachment.
+
+       The chunks are gzipped if bGzip and GZIP_DOWNLOADS are set and the
+       client accepts it."""
+    oResponse = Response(oChunks, mimetype=sMimeType)
+    if bGzip and app.config['GZIP_DOWNLOADS']:
+        oResponse.vary.add('Accept-Encoding')
+        if 'gzip' in request.accept_encodings:
+            from sutekhweb.export import gzip_chunks
+            oResponse.response = gzip_chunks(oChunks)
+            oResponse.content_encoding = 'gzip'
+    try:
+        sFileName.encode('ascii')
+        dNames = {'filename': sFileName}
+    except UnicodeEncodeError:
+        # Non-ascii names need the RFC 2231 encoded form, with an ascii
+        # fallback for older clients
+        dNames = {'filename': sFileName.encode('ascii', 'replace').decode(
+                      'ascii').replace('?', '_'),
+                  'filename*': "UTF-8''%s" % quote(sFileName, safe='')}
+    oResponse.headers.set('Content-Disposition', 'attachment', **dNames)
+    return oResponse
+
+
+def _get_code_token():
+    """Return a token which changes when the app or its templates change,
+       so cached pages aren't reused after an upgrade"""
+    sDir = os.path.dirname(os.path.abspath(__file__))
+    aFiles = [__file__]
+    sTemplateDir = os.path.join(sDir, 'templates')
+    if os.path.isdir(sTemplateDir):
+        aFiles.extend(os.path.join(sTemplateDir, x)
+                      for x in sorted(os.listdir(sTemplateDir)))
+    aTimes = []
+    for sFile in aFiles:
+        try:
+            aTimes.append(os.stat(sFile).st_mtime_ns)
+        except OSError:
+            pass
+    return repr(aTimes)
+
+
+CODE_TOKEN = _get_code_token()
+
+# The config settings which change the pages we send, so cached pages
+# aren't reused if they change
+RENDER_CONFIG = ('DATABASE_URI', 'ICONS', 'LAZY_GROUPS')
+# Set up by configure_caches
+CONFIG_TOKEN = None
+
+
+def make_etag():
+    """Create the ETag for the current request, based on the database
+       state and the request url"""
+    sKey = repr((get_db_generation(), CODE_TOKEN, CONFIG_TOKEN,
+                 request.full_path))
+    return hashlib.sha1(sKey.encode('utf8')).hexdigest()
+
+
+def conditional_get(fView):
+    """Add cache validators to a view which only reads the database.
+
+       A GET request with a matching If-None-Match header gets a 304
+       response without calling the view at all. The validators are only
+       sent if we can tell when the database changes."""
+    @wraps(fView)
+    def wrapper(*aArgs, **dKwargs):
+        if (request.method != 'GET' or not app.config['HTTP_CACHING'] or
+                not can_detect_changes()):
+            return fView(*aArgs, **dKwargs)
+        sETag = make_etag()
+        if request.if_none_match.contains(sETag):
+            oResponse = Response(status=304)
+        else:
+            oResponse = make_response(fView(*aArgs, **dKwargs))
+            if oResponse.status_code != 200:
+                return oResponse
+        oResponse.set_etag(sETag)
+        oModified = get_db_modified()
+        if oModified:
+            oResponse.last_modified = oModified
+        iMaxAge = app.config['HTTP_CACHE_MAX_AGE']
+        if iMaxAge:
+            oResponse.headers['Cache-Control'] = 'public, max-age=%d' % iMaxAge
+        else:
+            oResponse.headers['Cache-Control'] = 'no-cache'
+        return oResponse
+    return wrapper
+
+
+def create_app(sConfigFile=None):
+    """Configure the web app and the database, and return the app.
+
+       The config is read from sConfigFile if given, and otherwise from
+       the file named by the SUTEKH_WEB_CONFIG environment variable,
+       if it's set."""
+    global DB_POOL, FORK_HANDLER_REGISTERED
+    oTimer = metrics.StartupTimer()
+    app.config.from_object(DefConfig)
+    if sConfigFile:
+        app.config.from_pyfile(sConfigFile)
+    else:
+        # We don't require the env be set
+        app.config.from_envvar('SUTEKH_WEB_CONFIG', silent=True)
+    if DB_POOL:
+        DB_POOL.uninstall()
+        DB_POOL = None
+    oConn = connectionForURI(app.config['DATABASE_URI'])
+    sqlhub.processConnection = oConn
+    if not can_detect_changes():
+        # Anything we cache is thrown away at the end of the request, so
+        # the indexes and card pages would just be rebuilt every time
+        app.logger.warning('Changes to %s can not be detected, so results'
+                           ' are only cached for a single request',
+                           app.config['DATABASE_URI'])
+        app.config['USE_CARD_INDEX'] = False
+        app.config['CARD_PAGE_CACHE'] = 'off'
+    configure_caches()
+    oTimer.step('config')
+    # Initialise database caches
+    init_join_caches()
+    oTimer.step('join_caches')
+    if app.config['USE_CARD_INDEX']:
+        CARD_INDEX.build()
+    # The search suggestions always use the index
+    SEARCH_INDEX.build()
+    oTimer.step('card_indexes')
+    CARDSET_SUMMARIES.clear()
+    get_list_filter_values()
+    oTimer.step('filter_values')
+    if app.config['PRECOMPILE_TEMPLATES']:
+        precompile_templates()
+    oTimer.step('templates')
+    warm_card_page_cache()
+    oTimer.step('card_pages')
+    if app.config['DB_POOL_SIZE'] and ConnectionPool.can_pool(oConn):
+        DB_POOL = ConnectionPool(oConn, app.config['DB_POOL_SIZE'],
+                                 app.config['DB_POOL_TIMEOUT'])
+        DB_POOL.install()
+    if not FORK_HANDLER_REGISTERED:
+        os.register_at_fork(before=before_fork,
+                            after_in_parent=after_fork_parent,
+                            after_in_child=after_fork)
+        FORK_HANDLER_REGISTERED = True
+    metrics.REGISTRY.set_startup(oTimer.aSteps)
+    app.logger.info('Started in %.2fs (%s)', oTimer.total,
+                    ', '.join('%s %.2fs' % x for x in oTimer.aSteps))
+    return app
+
+
+def before_fork():
+    """Prepare to fork worker processes.
+
+       When the app is created before a server forks its workers, such as
+       with gunicorn's --preload, the workers share the caches built at
+       startup. Freezing the garbage collector stops collections in the
+       workers touching, and so copying, the pages holding them."""
+    gc.freeze()
+
+
+def after_fork_parent():
+    """Let the garbage collector see everything again in the parent.
+
+       The parent may keep handling requests, or fork again later, so
+       leaving the objects frozen would stop them ever being collected."""
+    gc.unfreeze()
+
+
+def after_fork():
+    """Give a forked worker its own database connections.
+
+       SQLite connections can't safely be used by both processes after a
+       fork, so the worker drops the ones it inherited."""
+    forget_connections(sqlhub.processConnection)
+    if DB_POOL:
+        DB_POOL.after_fork()
+
+
+@app.before_request
+def start_caching():
+    """Let the caches know a new request has started"""
+    start_request()
+
+
+@app.before_request
+def bind_connection():
+    """Give the request its own database connection from the pool"""
+    if DB_POOL:
+        DB_POOL.bind()
+
+
+@app.teardown_request
+def release_connection(_oExc):
+    """Return the request's database connection to the pool"""
+    if DB_POOL:
+        DB_POOL.unbind()
+
+
+@app.before_request
+def start_metrics():
+    """Start collecting metrics for the request, if enabled"""
+    if not app.config['METRICS']:
+        return
+    metrics.instrument_connection(sqlhub.processConnection)
+    oStats = metrics.start_request(request.endpoint or 'unknown')
+    if app.config['PROFILE_SLOW_REQUESTS']:
+        oStats.start_profile()
+
+
+@app.teardown_request
+def finish_metrics(_oExc):
+    """Record the metrics for the request, and save the profile if
+       the request was slow"""
+    oStats, fElapsed = metrics.end_request()
+    if oStats is None:
+        return
+    fThreshold = app.config['PROFILE_SLOW_REQUESTS']
+    if fThreshold and fElapsed > fThreshold:
+        sDir = app.config['PROFILE_DIR'] or tempfile.gettempdir()
+        sFileName = oStats.dump_profile(sDir)
+        if sFileName:
+            app.logger.warning('Slow request to %s (%.3fs), profile saved'
+                               ' to %s', request.path, fElapsed, sFileName)
+
+
+@before_render_template.connect_via(app)
+def _start_template_timer(_oSender, **_dKwargs):
+    """Note when template rendering started"""
+    if app.config['METRICS']:
+        g.fTemplateStart = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def _stop_template_timer(_oSender, **_dKwargs):
+    """Add the time spent rendering to the request's metrics"""
+    fStart = g.pop('fTemplateStart', None)
+    if fStart is not None:
+        metrics.add_template_time(time.perf_counter() - fStart)
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Report the collected metrics in the Prometheus text format"""
+    if not app.config['METRICS']:
+        abort(404)
+    return Response(metrics.REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/')
@@ -178,16 +667,26 @@ def start():
     return render_template('index.html', groupings=sorted(ALLOWED_GROUPINGS))
 
 
-def get_all_children(oParent, iId, oParNode=None):
-    """Get all the child card sets of the given parent card set and add
-       then to a CardSetTree"""
+def get_all_children(dChildren, iParentId, iId, oParNode=None,
+                     dSummaries=None):
+    """Get all the child card sets of the given parent card set id and add
+       them to a CardSetTree.
+
+       dChildren maps card set ids to the (id, name, inuse) tuples of
+       their children, so this doesn't need to touch the database.
+       dSummaries, if given, maps card set ids to their summaries, which
+       are used for the card counts."""
     aResult = []
-    for oCS in sorted(find_children(oParent), key=lambda x: x.name):
+    for iCSId, sName, bInUse in sorted(dChildren.get(iParentId, []),
+                                       key=lambda x: x[1]):
         iId += 1
-        oTree = CardSetTree(oCS.name, oCS.inuse, oParNode, iId)
+        oTree = CardSetTree(sName, bInUse, oParNode, iId)
+        if dSummaries and iCSId in dSummaries:
+            oTree.counts = dSummaries[iCSId].get_counts()
         aResult.append(oTree)
-        if has_children(oCS):
-            oTree.children, iId = get_all_children(oCS, iId, oTree)
+        if iCSId in dChildren:
+            oTree.children, iId = get_all_children(dChildren, iCSId, iId,
+                                                   oTree, dSummaries)
             if oTree.children:
                 iNumInUse = len([x for x in oTree.children if x.inuse])
                 if len(oTree.children) == 1:
@@ -202,17 +701,127 @@ def get_all_children(oParent, iId, oParNode=None):
     return aResult, iId
 
 
+def get_card_set_children():
+    """Return a dictionary mapping card set ids (None for the top level)
+       to the (id, name, inuse) tuples of their children.
+
+       All the card sets are loaded with a single query."""
+    # pylint: disable=protected-access
+    # we need the connection to run the query
+    oConn = PhysicalCardSet._connection
+    dChildren = {}
+    for iCSId, sName, bInUse, iParentId in oConn.queryAll(
+            'SELECT id, name, inuse, parent_id FROM physical_card_set'):
+        dChildren.setdefault(iParentId, []).append((iCSId, sName,
+                                                    bool(bInUse)))
+    return dChildren
+
+
+def get_card_set_tree():
+    """Return the list of top level CardSetTree objects.
+
+       The tree is cached until the database changes."""
+    aTree = CARDSET_TREE_CACHE.get('tree')
+    if aTree is not None:
+        return aTree
+    dChildren = get_card_set_children()
+    aTree, iNodes = get_all_children(dChildren, None, 0, None,
+                                     CARDSET_SUMMARIES.get_all())
+    metrics.add_rows('tree_nodes', iNodes)
+    CARDSET_TREE_CACHE.set('tree', aTree)
+    return aTree
+
+
 @app.route('/cardsets')
+@conditional_get
 def cardsets():
     """List the collections card sets"""
-    aCardSets, _ = get_all_children(None, 0)
-    return render_template('cardsets.html', cardsets=aCardSets)
+    return render_template('cardsets.html', cardsets=get_card_set_tree())
+
+
+def parse_filter(sFilter):
+    """Parse the filter string.
+
+       Returns the filter, or None if there's no filter or it's invalid,
+       and a normalised version of the filter to use as a cache key."""
+    if sFilter and sFilter != 'None':
+        try:
+            oAST = PARSER.apply(sFilter)
+            # The AST's string form gives us a normalised version of
+            # the filter to use as the cache key
+            return oAST.get_filter(), str(oAST)
+        except Exception:
+            pass
+    return None, ''
+
+
+def get_grouping_name(sGrouping):
+    """Return the name of the grouping to use, defaulting to grouping by
+       card type"""
+    if sGrouping in ALLOWED_GROUPINGS:
+        return sGrouping
+    return 'Card Type'
+
+
+def get_filtered_card_set_counts(oCS, sFilter):
+    """Count the cards in the card set that match the filter string.
+
+       Returns the same results as get_card_set_counts. Invalid filters
+       are ignored."""
+    aCardIds = aPhysCardIds = None
+    oCardFilter, _sKey = parse_filter(sFilter)
+    if oCardFilter:
+        try:
+            if app.config['USE_CARD_INDEX']:
+                aCardIds = CARD_INDEX.get_card_ids(oCardFilter)
+            if aCardIds is None:
+                oCSFilter = PhysicalCardSetFilter(oCS.name)
+                oFilter = FilterAndBox([oCSFilter, oCardFilter])
+                aResults = oFilter.select(MapPhysicalCardToPhysicalCardSet)
+                aPhysCardIds = set(x.physicalCardID for x in aResults)
+        except Exception:
+            aCardIds = aPhysCardIds = None
+    return get_card_set_counts(oCS, aCardIds, aPhysCardIds)
+
+
+def get_grouped_card_set(oCS, sFilter):
+    """Return the GroupedCards of the CardCounts for the card set cards
+       matching the filter, and the crypt & library counts.
+
+       The results are cached, so changing the grouping doesn't need to
+       count the cards again."""
+    _oFilter, sKey = parse_filter(sFilter)
+    if not sKey:
+        # Keep the whole card set with its summary, so it's only
+        # discarded when the card set changes
+        oGeneration = get_db_generation()
+        oSummary = CARDSET_SUMMARIES.get(oCS.id)
+        oResult = oSummary.get_derived('grouped')
+        if oResult is None:
+            dCards, dCounts = get_card_set_counts(oCS)
+            oResult = (GroupedCards(dCards.values(), ALLOWED_GROUPINGS,
+                                    lambda x: x.card, make_count_row),
+                       dCounts)
+            metrics.add_rows('cards_grouped', len(dCards))
+            oSummary.set_derived('grouped', oResult, oGeneration)
+        return oResult
+    oKey = (sKey, oCS.id)
+    oCached = CARDLIST_CACHE.get(oKey)
+    if oCached is not None:
+        return oCached
+    dCards, dCounts = get_filtered_card_set_counts(oCS, sFilter)
+    oResult = (GroupedCards(dCards.values(), ALLOWED_GROUPINGS,
+                            lambda x: x.card, make_count_row), dCounts)
+    metrics.add_rows('cards_grouped', len(dCards))
+    CARDLIST_CACHE.set(oKey, oResult)
+    return oResult
 
 
 @app.route('/cardsetview/<sCardSetName>', methods=['GET', 'POST'])
 @app.route('/cardsetview/<sCardSetName>/<sGrouping>', methods=['GET', 'POST'])
 @app.route('/cardsetview/<sCardSetName>/<sGrouping>/<sExpMode>',
            methods=['GET', 'POST'])
+@conditional_get
 def cardsetview(sCardSetName, sGrouping=None, sExpMode='Hide'):
     """Show the card set with the given name and parameters"""
     sCorrectName = unquote(sCardSetName)
@@ -238,21 +847,18 @@ def cardsetview(sCardSetName, sGrouping=None, sExpMode='Hide'):
                                     grouping=sGrouping))
         elif 'download' in request.form:
             if oCS:
-                oWriter = PhysicalCardSetWriter()
-                oXMLFile = StringIO()
-                oWriter.write(oXMLFile, CardSetWrapper(oCS))
-                oXMLFile.seek(0)  # reset to start
-                # Convert to bytes for flask
-                oOutput = BytesIO(oXMLFile.getvalue().encode('utf8'))
-                oOutput.seek(0)
-                return send_file(oOutput,
-                                 mimetype="application/octet-stream",
-                                 as_attachment=True,
-                                 attachment_filename=safe_filename(
-                                     "%s.xml" % sCorrectName))
+                # Downloads are rare, so the export code is only imported
+                # when it's needed
+                from sutekhweb.export import iter_card_set_xml
+                return download_response(iter_card_set_xml(oCS),
+                                         safe_filename("%s.xml" %
+                                                       sCorrectName))
             else:
                 return render_template('invalid.html', type='Card Set Name',
                                        requested=sCardSetName)
+        elif 'downloadzip' in request.form:
+            return redirect(url_for('export_card_sets',
+                                    sCardSetName=sCardSetName))
         elif 'expansions' in request.form:
             sFilter = request.values.get('curfilter', '')
             sGrouping = request.values.get('curgrouping', 'Card Type')
@@ -268,49 +874,186 @@ def cardsetview(sCardSetName, sGrouping=None, sExpMode='Hide'):
                                         sExpMode='Show', filter=sFilter))
     elif request.method == 'GET':
         if oCS:
-            dCards = {}
-            dCounts = {'crypt': 0, 'library': 0}
-            cGrouping = ALLOWED_GROUPINGS.get(sGrouping, CardTypeGrouping)
             sFilter = request.args.get('filter', None)
-            if sFilter and sFilter != 'None':
-                try:
-                    oCardFilter = PARSER.apply(sFilter).get_filter()
-                    oCSFilter = PhysicalCardSetFilter(oCS.name)
-                    oFilter = FilterAndBox([oCSFilter, oCardFilter])
-                    aResults = oFilter.select(MapPhysicalCardToPhysicalCardSet)
-                    aCards = [IPhysicalCard(x) for x in aResults]
-                except Exception:
-                    aCards = oCS.cards
-            else:
-                aCards = oCS.cards
-            for oCard in aCards:
-                iCardCount = CardCount(oCard.abstractCard)
-                oCount = dCards.setdefault(oCard.abstractCard, iCardCount)
-                oCount.cnt += 1
-                iPrintingCount = PrintingCount(oCard.printing)
-                oPrintingCount = oCount.printings.setdefault(oCard.printing,
-                                                         iPrintingCount)
-                oPrintingCount.cnt += 1
-                if is_crypt_card(oCard.abstractCard):
-                    dCounts['crypt'] += 1
-                else:
-                    dCounts['library'] += 1
-            aGrouped = cGrouping(dCards.values(), lambda x: x.card)
+            oGrouped, dCounts = get_grouped_card_set(oCS, sFilter)
+            aGrouped = oGrouped.group(get_grouping_name(sGrouping), True)
             bShowExpansions = (sExpMode == 'Show')
             if not sGrouping:
                 sGrouping = 'Card Type'
-            return render_template('cardsetview.html', cardset=oCS,
-                                   grouped=aGrouped, counts=dCounts,
-                                   quotedname=quote(oCS.name, safe=''),
-                                   curfilter=sFilter,
-                                   grouping=sGrouping,
-                                   showexpansions=bShowExpansions)
+            return render_large_template('cardsetview.html', cardset=oCS,
+                                         grouped=aGrouped, counts=dCounts,
+                                         quotedname=quote(oCS.name, safe=''),
+                                         curfilter=sFilter,
+                                         grouping=sGrouping,
+                                         showexpansions=bShowExpansions,
+                                         lazy=app.config['LAZY_GROUPS'])
         else:
             return render_template('invalid.html', type='Card Set Name',
                                    requested=sCardSetName)
 
 
+def get_group_arg(aGrouped):
+    """Return the cards in the group given by the 'group' argument.
+
+       Groups are numbered from 1, in the order they're shown."""
+    try:
+        iGroup = int(request.args.get('group', ''))
+    except ValueError:
+        abort(404)
+    if iGroup < 1 or iGroup > len(aGrouped):
+        abort(404)
+    return iGroup, aGrouped[iGroup - 1][1]
+
+
+@app.route('/cardsetview/<sCardSetName>/rows')
+@conditional_get
+def cardsetview_rows(sCardSetName):
+    """Return the table rows for the cards in a group of the card set
+       view, or the printings of one of those cards if 'card' is given,
+       for expanding the tree on demand"""
+    try:
+        oCS = IPhysicalCardSet(unquote(sCardSetName))
+    except SQLObjectNotFound:
+        abort(404)
+    sFilter = request.args.get('filter', None)
+    sGrouping = get_grouping_name(request.args.get('grouping'))
+    oGrouped, _dCounts = get_grouped_card_set(oCS, sFilter)
+    iGroup, aCards = get_group_arg(oGrouped.group(sGrouping, True))
+    iCard = None
+    oItem = None
+    if 'card' in request.args:
+        try:
+            iCard = int(request.args['card'])
+        except ValueError:
+            abort(404)
+        if iCard < 1 or iCard > len(aCards):
+            abort(404)
+        oItem = aCards[iCard - 1]
+    bShowExpansions = request.args.get('showexp') == 'Show'
+    return render_template('cardsetview_rows.html', cards=aCards,
+                           item=oItem, groupindex=iGroup, cardindex=iCard,
+                           quotedname=quote(oCS.name, safe=''),
+                           curfilter=sFilter, grouping=sGrouping,
+                           showexpansions=bShowExpansions)
+
+
+def safe_path_component(sName):
+    """Turn the card set name into a file or directory name which
+       can't escape the directory it's extracted into"""
+    # Leading dots would give hidden files, or the '.' and '..' entries
+    sName = safe_filename(sName).lstrip('.')
+    return sName or '_'
+
+
+def get_export_files(oCS):
+    """Return the (id, file name) pairs for the card set and all its
+       descendants.
+
+       Each card set's children are put in a directory named after it."""
+    dChildren = get_card_set_children()
+    aFiles = []
+    aUsed = set()
+    aStack = [(oCS.id, oCS.name, '')]
+    while aStack:
+        iCSId, sName, sDir = aStack.pop()
+        sPath = sDir + safe_path_component(sName)
+        # Different names can give the same file name, so ensure they
+        # stay distinct
+        sBase = sPath
+        iNum = 1
+        while sPath.lower() in aUsed:
+            iNum += 1
+            sPath = '%s_%d' % (sBase, iNum)
+        aUsed.add(sPath.lower())
+        aFiles.append((iCSId, sPath + '.xml'))
+        # Reversed, so the children are popped in name order
+        for iChildId, sChild, _bInUse in sorted(dChildren.get(iCSId, []),
+                                                key=lambda x: x[1],
+                                                reverse=True):
+            aStack.append((iChildId, sChild, sPath + '/'))
+    return aFiles
+
+
+@app.route('/cardsetexport/<sCardSetName>')
+@conditional_get
+def export_card_sets(sCardSetName):
+    """Download the card set and all its descendants as a zip file of
+       Sutekh XML files"""
+    sCorrectName = unquote(sCardSetName)
+    try:
+        oCS = IPhysicalCardSet(sCorrectName)
+    except SQLObjectNotFound:
+        return render_template('invalid.html', type='Card Set Name',
+                               requested=sCardSetName)
+    aFiles = get_export_files(oCS)
+    from sutekhweb.export import iter_card_sets_zip
+    # zip files are already compressed, so there's no point in gzipping
+    return download_response(
+        iter_card_sets_zip(aFiles, app.config['EXPORT_WORKERS']),
+        safe_filename("%s.zip" % sCorrectName), "application/zip",
+        bGzip=False)
+
+
+def get_card_text_lines(oCard):
+    """Split the card text into lines for display, marking errata"""
+    if not oCard.text:
+        return []
+    # Mark errata clearly
+    sText = oCard.text.replace(
+        '{', '<span class="errata">').replace('}', '</span>')
+    # We split text into lines, so they can be neatly
+    # formatted by the template
+    # FIXME: This is messy - should we preserve more formatting
+    # in the database?
+    aText = sText.split("\n")
+    if '. [' in aText[-1]:
+        # Split discipline level text
+        aSplit = aText.pop().split('. [')
+        # Fix the lines
+        aText.append(aSplit[0] + '.')
+        for sLine in aSplit[1:-1]:
+            aText.append('[' + sLine + '.')
+        aText.append('[' + aSplit[-1])
+    return aText
+
+
+def get_card_expansions(oCard):
+    """Return a sorted list of (expansion, rarities) for the card"""
+    if not oCard.rarity:
+        return []
+    dExp = {}
+    for oPair in oCard.rarity:
+        dExp.setdefault(oPair.expansion.name, [])
+        dExp[oPair.expansion.name].append(oPair.rarity.name)
+    # Create the sorted display list
+    return [(x, ", ".join(sorted(dExp[x]))) for x in sorted(dExp)]
+
+
+def get_card_rulings(oCard):
+    """Return a list of (text, code, url) for the card's rulings"""
+    if not oCard.rulings:
+        return []
+    return [(oR.text.replace("\n", " "), oR.code, oR.url)
+            for oR in oCard.rulings]
+
+
+def render_card_page(oCard):
+    """Render the details page for the card"""
+    aText = get_card_text_lines(oCard)
+    if app.config['ICONS']:
+        # Extract icons
+        dIcons = ICON_MANAGER.get_all_icons(oCard)
+    else:
+        dIcons = {}
+    aExpansions = get_card_expansions(oCard)
+    aRulings = get_card_rulings(oCard)
+    return render_template('card.html', card=oCard, text=aText,
+                           icons=dIcons, expansions=aExpansions,
+                           rulings=aRulings)
+
+
 @app.route('/card/<sCardName>')
+@conditional_get
 def print_card(sCardName):
     """Display card details"""
     try:
@@ -318,53 +1061,52 @@ def print_card(sCardName):
     except SQLObjectNotFound:
         oCard = None
     if oCard:
-        if oCard.text:
-            # Mark errata clearly
-            sText = oCard.text.replace(
-                '{', '<span class="errata">').replace('}', '</span>')
-            # We split text into lines, so they can be neatly
-            # formatted by the template
-            # FIXME: This is messy - should we preserve more formatting
-            # in the database?
-            aText = sText.split("\n")
-            if '. [' in aText[-1]:
-                # Split discipline level text
-                aSplit = aText.pop().split('. [')
-                # Fix the lines
-                aText.append(aSplit[0] + '.')
-                for sLine in aSplit[1:-1]:
-                    aText.append('[' + sLine + '.')
-                aText.append('[' + aSplit[-1])
-        else:
-            aText = []
-        if app.config['ICONS']:
-            # Extract icons
-            dIcons = ICON_MANAGER.get_all_icons(oCard)
-        else:
-            dIcons = {}
-        if oCard.rarity:
-            dExp = {}
-            for oPair in oCard.rarity:
-                dExp.setdefault(oPair.expansion.name, [])
-                dExp[oPair.expansion.name].append(oPair.rarity.name)
-            # Create the sorted display list
-            aExpansions = [(x, ", ".join(sorted(dExp[x])))
-                           for x in sorted(dExp)]
-        else:
-            aExpansions = []
-        if oCard.rulings:
-            aRulings = [(oR.text.replace("\n", " "), oR.code, oR.url)
-                        for oR in oCard.rulings]
-        else:
-            aRulings = []
-        return render_template('card.html', card=oCard, text=aText,
-                               icons=dIcons, expansions=aExpansions,
-                               rulings=aRulings)
+        # The page only depends on the card, but the urls depend on where
+        # the app is mounted
+        oKey = (oCard.id, request.script_root)
+        sPage = CARD_PAGE_CACHE.get(oKey)
+        if sPage is None:
+            check_card_page_root()
+            sPage = render_card_page(oCard)
+            CARD_PAGE_CACHE.set(oKey, sPage)
+        return sPage
     else:
         return render_template('invalid.html', type='Card Name',
                                requested=sCardName)
 
 
+def warm_card_page_cache():
+    """Render the card pages in advance if CARD_PAGE_CACHE is 'eager'.
+
+       The pages are rendered for the app mounted at APPLICATION_ROOT,
+       so that needs to be set if the app is mounted under a prefix."""
+    global CARD_PAGE_ROOT
+    CARD_PAGE_ROOT = None
+    if app.config['CARD_PAGE_CACHE'] != 'eager':
+        return
+    # Render as if we were handling a request to the app root. Flask
+    # uses APPLICATION_ROOT as the script root for the fake request
+    with app.test_request_context():
+        CARD_PAGE_ROOT = request.script_root
+        for oCard in AbstractCard.select():
+            if len(CARD_PAGE_CACHE) >= CARD_PAGE_CACHE.iMaxSize:
+                break
+            CARD_PAGE_CACHE.set((oCard.id, request.script_root),
+                                render_card_page(oCard))
+
+
+def check_card_page_root():
+    """Warn, once, if the card pages were rendered in advance for a
+       different script root to the one the app is mounted at"""
+    global CARD_PAGE_ROOT
+    if CARD_PAGE_ROOT is not None and CARD_PAGE_ROOT != request.script_root:
+        app.logger.warning('Card pages were rendered for %r, but the app is'
+                           ' mounted at %r. Set APPLICATION_ROOT to use the'
+                           ' eager card page cache',
+                           CARD_PAGE_ROOT, request.script_root)
+        CARD_PAGE_ROOT = None
+
+
 @app.route('/grouping', methods=['GET', 'POST'])
 def change_grouping():
     """Handle changing the grouping"""
@@ -400,8 +1142,49 @@ def change_grouping():
         print('Error, fell off the back of the world')
 
 
+def get_filtered_cardlist(sFilter):
+    """Return the GroupedCards for the card list matching the filter, and
+       the crypt & library counts.
+
+       The results are cached, so repeated views, with any grouping,
+       skip the database."""
+    oFilter, sKey = parse_filter(sFilter)
+    oFilter = oFilter or NullFilter()
+    oKey = (sKey, None)
+    oCached = CARDLIST_CACHE.get(oKey)
+    if oCached is not None:
+        return oCached
+    dCounts = {'crypt': 0, 'library': 0}
+    aCards = None
+    if app.config['USE_CARD_INDEX']:
+        aCards = CARD_INDEX.get_cards(oFilter)
+    if aCards is None:
+        aCards = list(oFilter.select(AbstractCard))
+    for oCard in aCards:
+        if is_crypt_card(oCard):
+            dCounts['crypt'] += 1
+        else:
+            dCounts['library'] += 1
+    oResult = (GroupedCards(aCards, ALLOWED_GROUPINGS, IAbstractCard,
+                            make_card_row), dCounts)
+    metrics.add_rows('cards_grouped', len(aCards))
+    CARDLIST_CACHE.set(oKey, oResult)
+    return oResult
+
+
+def get_grouped_cardlist(sFilter, sGrouping, bRows=False):
+    """Return the grouped card list and the crypt & library counts for
+       the given filter and grouping.
+
+       If bRows is set, the groups contain CardRows rather than the
+       cards."""
+    oGrouped, dCounts = get_filtered_cardlist(sFilter)
+    return oGrouped.group(get_grouping_name(sGrouping), bRows), dCounts
+
+
 @app.route('/cardlist', methods=['GET', 'POST'])
 @app.route('/cardlist/<sGrouping>', methods=['GET', 'POST'])
+@conditional_get
 def cardlist(sGrouping=None):
     """List the WW cardlist"""
     if request.method == 'POST':
@@ -414,30 +1197,35 @@ def cardlist(sGrouping=None):
             sGroup = request.values.get('curgrouping', 'Card Type')
             return redirect(url_for('filter', source='cardlist',
                                     grouping=sGroup))
+    sFilter = request.args.get('filter', None)
+    return render_cardlist(sFilter, sGrouping)
+
+
+def render_cardlist(sFilter, sGrouping):
+    """Render the card list page for the filter and grouping"""
     if sGrouping is None:
         sGroup = 'Card Type'
     else:
         sGroup = sGrouping
+    aGrpData, dCounts = get_grouped_cardlist(sFilter, sGrouping, True)
+    return render_large_template('cardlist.html', grouped=aGrpData,
+                                 groupings=sorted(ALLOWED_GROUPINGS),
+                                 counts=dCounts, grouping=sGroup,
+                                 curfilter=sFilter,
+                                 lazy=app.config['LAZY_GROUPS'])
+
+
+@app.route('/cardlist/rows')
+@conditional_get
+def cardlist_rows():
+    """Return the table rows for the cards in a group of the card list,
+       for expanding the tree on demand"""
     sFilter = request.args.get('filter', None)
-    if sFilter and sFilter != 'None':
-        try:
-            oFilter = PARSER.apply(sFilter).get_filter()
-        except Exception:
-            oFilter = NullFilter()
-    else:
-        oFilter = NullFilter()
-    dCounts = {'crypt': 0, 'library': 0}
-    cGrouping = ALLOWED_GROUPINGS.get(sGrouping, CardTypeGrouping)
-    for oCard in oFilter.select(AbstractCard):
-        if is_crypt_card(oCard):
-            dCounts['crypt'] += 1
-        else:
-            dCounts['library'] += 1
-    aGrpData = cGrouping(oFilter.select(AbstractCard), IAbstractCard)
-    return render_template('cardlist.html', grouped=aGrpData,
-                           groupings=sorted(ALLOWED_GROUPINGS),
-                           counts=dCounts, grouping=sGroup,
-                           curfilter=sFilter)
+    aGrouped, _dCounts = get_grouped_cardlist(
+        sFilter, request.args.get('grouping'), True)
+    iGroup, aCards = get_group_arg(aGrouped)
+    return render_template('cardlist_rows.html', cards=aCards,
+                           groupindex=iGroup)
 
 
 @app.route('/search', methods=['GET', 'POST'])
@@ -453,7 +1241,9 @@ def simple_search(sType='Card Name'):
             else:
                 return render_template('invalid.html', type='Search Type',
                                        requested=sType)
-            return redirect(url_for('cardlist', filter=sFilter))
+            # Show the results directly, rather than redirecting to
+            # the card list
+            return render_cardlist(sFilter, None)
         else:
             return redirect(url_for('cardlist'))
     else:
@@ -463,7 +1253,44 @@ def simple_search(sType='Card Name'):
                                requested=sType)
 
 
+SUGGEST_DEFAULT_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+
+
+@app.route('/search/suggest')
+def search_suggest():
+    """Return the cards best matching the query 'q', for typeahead"""
+    sQuery = request.args.get('q', '')
+    try:
+        iLimit = int(request.args.get('limit', SUGGEST_DEFAULT_LIMIT))
+    except ValueError:
+        return api_error('Invalid limit')
+    iLimit = max(0, min(iLimit, SUGGEST_MAX_LIMIT))
+    aResults = []
+    for iId, sMatch in SEARCH_INDEX.suggest(sQuery, iLimit):
+        sName = SEARCH_INDEX.get_name(iId)
+        aResults.append({'name': sName, 'match': sMatch,
+                         'url': url_for('print_card', sCardName=sName)})
+    return jsonify({'query': sQuery, 'results': aResults})
+
+
+def get_list_filter_values():
+    """Return the (element, name, values) tuples for the list filters on
+       the filter page.
+
+       Finding the values needs several queries, so they are cached until
+       the database changes."""
+    aListFilters = FILTER_VALUES_CACHE.get('values')
+    if aListFilters is None:
+        aListFilters = []
+        for sElement, sText, cCls in LIST_FILTERS:
+            aListFilters.append((sElement, sText, cCls.get_values()))
+        FILTER_VALUES_CACHE.set('values', aListFilters)
+    return aListFilters
+
+
 @app.route('/filter', methods=['GET', 'POST'])
+@conditional_get
 def filter():
     """Support some of the Sutekh Filter Options"""
     if request.method == 'POST':
@@ -495,9 +1322,7 @@ def filter():
         sCardSet = request.args.get('cardsetname', '')
         sExpMode = request.args.get('showexp', 'Hide')
         sGroupBy = request.args.get('grouping', 'Card Type')
-        aListFilters = []
-        for sElement, sText, cCls in LIST_FILTERS:
-            aListFilters.append((sElement, sText, cCls.get_values()))
+        aListFilters = get_list_filter_values()
         return render_template('filter.html', grouping=sGroupBy,
                                source=sSource, cardsetname=sCardSet,
                                showexp=sExpMode,
@@ -505,20 +1330,218 @@ def filter():
                                stringfilters=STRING_FILTERS)
 
 
-if __name__ == "__main__":
-    app.config.from_object(DefConfig)
+# JSON API
+API_VERSION = 1
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 1000
+
+
+def _get_disciplines(oCard):
+    """List the card's disciplines, in upper case for superior"""
+    aResult = []
+    for oPair in sorted(oCard.discipline, key=lambda x: x.discipline.name):
+        if oPair.level == 'superior':
+            aResult.append(oPair.discipline.name.upper())
+        else:
+            aResult.append(oPair.discipline.name.lower())
+    return aResult
+
+
+# Fields which can be requested for cards in the API
+CARD_FIELDS = {
+    'name': lambda oCard: oCard.name,
+    'url': lambda oCard: url_for('print_card', sCardName=oCard.name),
+    'text': lambda oCard: oCard.text,
+    'cardtype': lambda oCard: [x.name for x in oCard.cardtype],
+    'clan': lambda oCard: [x.name for x in oCard.clan],
+    'creed': lambda oCard: [x.name for x in oCard.creed],
+    'virtue': lambda oCard: [x.name for x in oCard.virtue],
+    'discipline': _get_disciplines,
+    'keywords': lambda oCard: [x.keyword for x in oCard.keywords],
+    'capacity': lambda oCard: oCard.capacity,
+    'life': lambda oCard: oCard.life,
+    'group': lambda oCard: oCard.group,
+    'cost': lambda oCard: oCard.cost,
+    'costtype': lambda oCard: oCard.costtype,
+    'artists': lambda oCard: [x.name for x in oCard.artists],
+    'expansions': lambda oCard: [{'expansion': sExp, 'rarity': sRarity}
+                                 for sExp, sRarity in
+                                 get_card_expansions(oCard)],
+    'rulings': lambda oCard: [{'text': sText, 'code': sCode, 'url': sUrl}
+                              for sText, sCode, sUrl in
+                              get_card_rulings(oCard)],
+}
+
+DEF_LIST_FIELDS = ['name', 'url']
+
+
+class ApiError(Exception):
+    """Raised for bad requests to the JSON API"""
+
+
+def api_error(sMessage, iStatus=400):
+    """Return a JSON error response"""
+    oResponse = jsonify(version=API_VERSION, error=sMessage)
+    oResponse.status_code = iStatus
+    return oResponse
+
+
+def get_api_fields(aDefault):
+    """Return the list of card fields requested by the 'fields' argument"""
+    sFields = request.args.get('fields', '')
+    aFields = [x.strip() for x in sFields.split(',') if x.strip()]
+    if not aFields:
+        return aDefault
+    aUnknown = [x for x in aFields if x not in CARD_FIELDS]
+    if aUnknown:
+        raise ApiError('Unknown fields: %s' % ', '.join(aUnknown))
+    return aFields
+
+
+def get_api_page():
+    """Return the offset and limit requested"""
     try:
-        app.config.from_envvar('SUTEKH_WEB_CONFIG')
-    except RuntimeError:
-        # We don't require the env be set, so ignore
-        # this runtime error
-        pass
-    oConn = connectionForURI(app.config['DATABASE_URI'])
-    sqlhub.processConnection = oConn
-    bDebug = app.config['DEBUG']
-    # Initialise database caches
-    init_cache()
-    if bDebug:
+        iOffset = int(request.args.get('offset', 0))
+        iLimit = int(request.args.get('limit', API_DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('offset and limit must be integers')
+    if iOffset < 0 or iLimit < 1:
+        raise ApiError('offset must be positive and limit at least 1')
+    return iOffset, min(iLimit, API_MAX_LIMIT)
+
+
+def get_api_grouping():
+    """Return the name of the grouping requested"""
+    sGrouping = request.args.get('grouping', 'No')
+    if sGrouping not in ALLOWED_GROUPINGS:
+        raise ApiError('Unknown grouping: %s' % sGrouping)
+    return sGrouping
+
+
+def get_api_filter():
+    """Return the filter string requested, or None if there isn't one"""
+    sFilter = request.args.get('filter', None)
+    if sFilter:
+        _oFilter, sKey = parse_filter(sFilter)
+        if not sKey:
+            raise ApiError('Invalid filter: %s' % sFilter)
+    return sFilter
+
+
+def card_to_dict(oCard, aFields):
+    """Convert the card into a dictionary with the given fields"""
+    return dict((sField, CARD_FIELDS[sField](oCard)) for sField in aFields)
+
+
+def make_page(aItems, iOffset, iLimit):
+    """Return the pagination info and the slice of aItems for the page"""
+    iTotal = len(aItems)
+    iNext = iOffset + iLimit
+    dPage = {'version': API_VERSION,
+             'total': iTotal,
+             'offset': iOffset,
+             'limit': iLimit,
+             'next_offset': iNext if iNext < iTotal else None}
+    return dPage, aItems[iOffset:iNext]
+
+
+def flatten_groups(aGrouped):
+    """Flatten the grouped results into a list of (group, item) pairs.
+
+       The items are already sorted by card name in each group."""
+    aResult = []
+    for sGroup, aItems in aGrouped:
+        for oItem in aItems:
+            aResult.append((sGroup, oItem))
+    return aResult
+
+
+@app.route('/api/cardlist')
+@app.route('/api/v%d/cardlist' % API_VERSION)
+@conditional_get
+def api_cardlist():
+    """Return a page of the filtered card list as JSON"""
+    try:
+        aFields = get_api_fields(DEF_LIST_FIELDS)
+        iOffset, iLimit = get_api_page()
+        sGrouping = get_api_grouping()
+        sFilter = get_api_filter()
+    except ApiError as oErr:
+        return api_error(str(oErr))
+    aGrpData, dCounts = get_grouped_cardlist(sFilter, sGrouping)
+    dResult, aPage = make_page(flatten_groups(aGrpData),
+                               iOffset, iLimit)
+    aCards = []
+    for sGroup, oCard in aPage:
+        dCard = card_to_dict(oCard, aFields)
+        dCard['group_name'] = sGroup
+        aCards.append(dCard)
+    dResult.update({'grouping': sGrouping, 'filter': sFilter,
+                    'counts': dCounts, 'cards': aCards})
+    return jsonify(dResult)
+
+
+@app.route('/api/cardset/<sCardSetName>')
+@app.route('/api/v%d/cardset/<sCardSetName>' % API_VERSION)
+@conditional_get
+def api_cardset(sCardSetName):
+    """Return the card set details and a page of its cards as JSON"""
+    try:
+        aFields = get_api_fields(DEF_LIST_FIELDS)
+        iOffset, iLimit = get_api_page()
+        sGrouping = get_api_grouping()
+        sFilter = get_api_filter()
+    except ApiError as oErr:
+        return api_error(str(oErr))
+    sCorrectName = unquote(sCardSetName)
+    try:
+        oCS = IPhysicalCardSet(sCorrectName)
+    except SQLObjectNotFound:
+        return api_error('Unknown card set: %s' % sCorrectName, 404)
+    oGrouped, dCounts = get_grouped_card_set(oCS, sFilter)
+    dResult, aPage = make_page(flatten_groups(oGrouped.group(sGrouping)),
+                               iOffset, iLimit)
+    aCards = []
+    for sGroup, oCount in aPage:
+        dCard = card_to_dict(oCount.card, aFields)
+        dCard['group_name'] = sGroup
+        dCard['count'] = oCount.cnt
+        dCard['printings'] = [
+            {'name': oPrint.print_name, 'count': oPrint.cnt}
+            for oPrint in sorted(oCount.printings.values(),
+                                 key=lambda x: x.print_name)]
+        aCards.append(dCard)
+    dResult.update({'name': oCS.name, 'author': oCS.author,
+                    'comment': oCS.comment,
+                    'annotations': oCS.annotations,
+                    'inuse': oCS.inuse,
+                    'parent': oCS.parent.name if oCS.parent else None,
+                    'grouping': sGrouping, 'filter': sFilter,
+                    'counts': dCounts, 'cards': aCards})
+    return jsonify(dResult)
+
+
+@app.route('/api/card/<sCardName>')
+@app.route('/api/v%d/card/<sCardName>' % API_VERSION)
+@conditional_get
+def api_card(sCardName):
+    """Return the card details as JSON"""
+    try:
+        aFields = get_api_fields(sorted(CARD_FIELDS))
+    except ApiError as oErr:
+        return api_error(str(oErr))
+    try:
+        oCard = IAbstractCard(sCardName)
+    except SQLObjectNotFound:
+        return api_error('Unknown card: %s' % sCardName, 404)
+    dResult = card_to_dict(oCard, aFields)
+    dResult['version'] = API_VERSION
+    return jsonify(dResult)
+
+
+if __name__ == "__main__":
+    create_app()
+    if app.config['DEBUG']:
         app.run()
     else:
         app.run(host=app.config['LISTEN'])
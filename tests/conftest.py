@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Shared fixtures for the tests.
+
+   The tests run against a small synthetic database, built with the
+   benchmark's database generator."""
+
+import os
+
+import pytest
+
+from sutekhweb.benchmark import make_database
+from sutekhweb.db import init_join_caches
+from sutekhweb.sutekhweb import create_app
+
+
+@pytest.fixture(scope='session')
+def card_db(tmp_path_factory):
+    """Build the synthetic database and make it the process connection"""
+    sPath = os.path.join(str(tmp_path_factory.mktemp('db')), 'cards.db')
+    oConn = make_database(sPath, iCards=300, iSets=10, iDepth=3,
+                          iCardsPerSet=20, iSeed=1)
+    init_join_caches()
+    return oConn
+
+
+
+@pytest.fixture(scope='session')
+def web_app(card_db, tmp_path_factory):
+    """Create the web app, using the test database"""
+    sConfig = os.path.join(str(tmp_path_factory.mktemp('config')),
+                           'config.py')
+    with open(sConfig, 'w') as oFile:
+        oFile.write('DATABASE_URI = %r\n' % card_db.uri())
+    return create_app(sConfig)
+
+
+@pytest.fixture
+def client(web_app):
+    """A test client for the web app"""
+    return web_app.test_client()
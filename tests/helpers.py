@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Helper functions shared by the tests"""
+
+import sqlite3
+import time
+
+from sutekh.base.core.BaseTables import AbstractCard
+
+from sutekhweb.sutekhweb import parse_filter
+
+
+def db_card_ids(sFilter):
+    """Return the ids of the cards matching the filter string, using the
+       database"""
+    oFilter, _sKey = parse_filter(sFilter)
+    return {x.id for x in oFilter.select(AbstractCard)}
+
+
+def write_db(oConn, sQuery, aArgs=()):
+    """Change the database behind SQLObject's back, as another process,
+       such as the Sutekh gui, would"""
+    # Make sure the file's modification time changes
+    time.sleep(0.01)
+    oDB = sqlite3.connect(oConn.filename)
+    oDB.execute(sQuery, aArgs)
+    oDB.commit()
+    oDB.close()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check the JSON API rejects bad arguments"""
+
+from urllib.parse import quote
+
+import pytest
+
+from tests.helpers import db_card_ids
+
+CARD_SET = quote('Card Set 0')
+
+
+@pytest.mark.parametrize('sUrl', ['/api/cardlist',
+                                  '/api/cardset/%s' % CARD_SET])
+@pytest.mark.parametrize('sArgs', ['filter=CardType%20%3D', 'grouping=Bad',
+                                   'offset=x', 'limit=0'])
+def test_bad_arguments(client, sUrl, sArgs):
+    """Bad arguments get a 400 response with a JSON error"""
+    oResponse = client.get('%s?%s' % (sUrl, sArgs))
+    assert oResponse.status_code == 400
+    assert oResponse.get_json()['error']
+
+
+def test_filtered_cardlist(client):
+    """A valid filter is applied"""
+    sFilter = 'Clan = "Brujah"'
+    oResponse = client.get('/api/cardlist?limit=1000&filter=%s'
+                           % quote(sFilter))
+    assert oResponse.status_code == 200
+    dResult = oResponse.get_json()
+    assert dResult['filter'] == sFilter
+    assert dResult['total'] == len(db_card_ids(sFilter))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check when cached results are discarded"""
+
+import pytest
+from sqlobject import sqlhub, connectionForURI
+
+from sutekhweb.cache import (ResultCache, can_detect_changes,
+                             get_db_generation, start_request)
+
+
+@pytest.fixture
+def memory_db(card_db):
+    """Switch to a database whose changes we can't detect"""
+    oOldConn = sqlhub.processConnection
+    sqlhub.processConnection = connectionForURI('sqlite:/:memory:')
+    yield sqlhub.processConnection
+    sqlhub.processConnection = oOldConn
+
+
+def test_sqlite_file_kept_between_requests(card_db):
+    """Results are kept between requests when using a sqlite file"""
+    assert can_detect_changes()
+    oCache = ResultCache(4)
+    start_request()
+    oCache.set('key', 'value')
+    start_request()
+    assert oCache.get('key') == 'value'
+
+
+def test_other_db_only_kept_for_request(memory_db):
+    """Results are only kept for the rest of the request when we can't
+       tell if the database has changed"""
+    assert not can_detect_changes()
+    oCache = ResultCache(4)
+    start_request()
+    oGeneration = get_db_generation()
+    oCache.set('key', 'value')
+    assert oCache.get('key') == 'value'
+    assert get_db_generation() == oGeneration
+    start_request()
+    assert get_db_generation() != oGeneration
+    assert oCache.get('key') is None
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check the card index gives the same answers as the database"""
+
+import pytest
+
+from sutekhweb.sutekhweb import CARD_INDEX, SEARCH_INDEX, parse_filter
+
+from tests.helpers import db_card_ids
+
+# Filters answered by the card index alone
+INDEXED_FILTERS = [
+    'CardType = "Vampire"',
+    'CardType in "Master", "Combat"',
+    'Clan = "Brujah"',
+    'Creed = "Judge"',
+    'Discipline = "Potence"',
+    'Virtue = "Defense"',
+    'Keyword = "unique"',
+    'NOT Clan = "Brujah"',
+    'Clan = "Brujah" OR Creed = "Judge"',
+    'CardType = "Vampire" AND Discipline = "Potence"',
+    'CardType = "Vampire" AND NOT (Clan = "Brujah" OR Clan = "Gangrel")',
+]
+
+# Filters answered by the search index
+SEARCH_FILTERS = [
+    'CardName = "Card 1"',
+    'CardName = "card 12"',
+    'CardText = "potence"',
+    'CardText = "Text for card 7."',
+]
+
+# Filters combining the search index and the card index
+MIXED_FILTERS = [
+    'CardName = "Card 1" AND NOT CardText = "brujah"',
+    'CardText = "gangrel" OR Clan = "Gangrel"',
+    'CardType = "Vampire" AND CardText = "auspex"',
+]
+
+
+@pytest.fixture(scope='module')
+def card_index(card_db):
+    """Build the card and search indexes from the test database"""
+    SEARCH_INDEX.build()
+    CARD_INDEX.build()
+    return CARD_INDEX
+
+
+@pytest.mark.parametrize('sFilter', INDEXED_FILTERS + SEARCH_FILTERS
+                         + MIXED_FILTERS)
+def test_index_matches_db(card_index, sFilter):
+    """The index finds the same cards as the database"""
+    oFilter, _sKey = parse_filter(sFilter)
+    aExpected = db_card_ids(sFilter)
+    # Make sure the test database actually exercises the filter
+    assert aExpected
+    aIds = card_index.get_card_ids(oFilter)
+    assert aIds is not None
+    assert set(aIds) == aExpected
+
+
+@pytest.mark.parametrize('sFilter', SEARCH_FILTERS)
+def test_search_index_matches_db(card_index, sFilter):
+    """The search index finds the same cards as the database"""
+    oFilter, _sKey = parse_filter(sFilter)
+    aIds = SEARCH_INDEX.get_ids(oFilter)
+    assert aIds is not None
+    assert set(aIds) == db_card_ids(sFilter)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check the pool of read-only database connections"""
+
+import threading
+import time
+
+import pytest
+from sqlobject.dberrors import OperationalError
+
+from sutekhweb import sutekhweb
+from sutekhweb.db import ConnectionPool, PoolTimeout
+
+# pylint: disable=protected-access
+# We check the pool's internal state
+
+
+@pytest.fixture
+def pool(card_db):
+    """A pool installed on a separate connection to the test database"""
+    oConn = type(card_db).connectionFromURI(card_db.uri())
+    oPool = ConnectionPool(oConn, 2, 0.2)
+    oPool.install()
+    yield oConn, oPool
+    oPool.uninstall()
+    oConn.close()
+
+
+def run_bound(oPool, fFunc):
+    """Call fFunc in a new thread, with a connection bound to it, and
+       return the thread, and an event to set to release the connection"""
+    oDone = threading.Event()
+
+    def _run():
+        oPool.bind()
+        try:
+            fFunc()
+            oDone.wait(5)
+        finally:
+            oPool.unbind()
+
+    oThread = threading.Thread(target=_run)
+    oThread.start()
+    return oThread, oDone
+
+
+def test_concurrent_requests(pool):
+    """Requests running at the same time get their own connections"""
+    oConn, oPool = pool
+    aRaw = []
+    oBarrier = threading.Barrier(2, timeout=5)
+
+    def _query():
+        oConn.queryOne('SELECT COUNT(*) FROM physical_card_set')
+        aRaw.append(oConn.getConnection())
+        oBarrier.wait()
+
+    aThreads = [run_bound(oPool, _query) for _iNum in range(2)]
+    for oThread, oDone in aThreads:
+        oDone.set()
+        oThread.join()
+    assert len(aRaw) == 2
+    assert aRaw[0] is not aRaw[1]
+    # Both connections are back in the pool, and reused
+    assert sorted(map(id, oPool._aFree)) == sorted(map(id, aRaw))
+    oPool.bind()
+    try:
+        assert oConn.getConnection() in aRaw
+    finally:
+        oPool.unbind()
+
+
+def test_writes_fail(pool):
+    """The pooled connections are read-only"""
+    oConn, oPool = pool
+    oPool.bind()
+    try:
+        with pytest.raises(OperationalError):
+            oConn.query("UPDATE physical_card_set SET comment = 'Changed'")
+    finally:
+        oPool.unbind()
+    # The connection is still usable by the next request
+    assert len(oPool._aFree) == 1
+
+
+def test_timeout(pool):
+    """Waiting for a connection gives up after the timeout"""
+    oConn, oPool = pool
+    aThreads = [run_bound(oPool, oConn.getConnection) for _iNum in range(2)]
+    # Wait for both threads to take their connection
+    fDeadline = time.monotonic() + 5
+    while oPool._iOpen < 2 and time.monotonic() < fDeadline:
+        time.sleep(0.01)
+    fStart = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        oPool.acquire()
+    fWaited = time.monotonic() - fStart
+    assert 0.2 <= fWaited < 2
+    aThreads[0][1].set()
+    aThreads[0][0].join()
+    # Once a connection is released, it can be had again
+    oRaw = oPool.acquire()
+    oPool.release(oRaw)
+    aThreads[1][1].set()
+    aThreads[1][0].join()
+
+
+def test_released_when_request_fails(client, monkeypatch):
+    """A request which raises still returns its connection to the pool"""
+    oPool = sutekhweb.DB_POOL
+    assert oPool is not None
+
+    def _fail():
+        """Query the database and then fail"""
+        sutekhweb.sqlhub.processConnection.queryOne(
+            'SELECT COUNT(*) FROM physical_card_set')
+        assert oPool._oLocal.oRaw is not None
+        raise RuntimeError('Broken view')
+
+    monkeypatch.setitem(sutekhweb.app.view_functions, 'cardsets',
+                        _fail)
+    oResponse = client.get('/cardsets')
+    assert oResponse.status_code == 500
+    assert oPool._oLocal.oRaw is None
+    assert len(oPool._aFree) == oPool._iOpen
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check the streamed card set downloads match Sutekh's own writer, and
+   the zip downloads are safe to extract"""
+
+import gzip
+import zipfile
+from io import BytesIO, StringIO
+from urllib.parse import quote
+
+import pytest
+
+from sutekh.base.core.BaseTables import PhysicalCardSet
+from sutekh.base.core.CardSetHolder import CardSetWrapper
+from sutekh.io.PhysicalCardSetWriter import PhysicalCardSetWriter
+
+from sutekhweb.export import (iter_card_set_xml, iter_card_sets_zip,
+                              gzip_chunks)
+from sutekhweb.sutekhweb import CARDSET_SUMMARIES, get_export_files
+
+
+def writer_xml(oCS):
+    """Return the card set as written by PhysicalCardSetWriter"""
+    oFile = StringIO()
+    PhysicalCardSetWriter().write(oFile, CardSetWrapper(oCS))
+    return oFile.getvalue().encode('ascii')
+
+
+@pytest.fixture
+def card_set(card_db):
+    """The card set with the most cards"""
+    return max(PhysicalCardSet.select(),
+               key=lambda x: CARDSET_SUMMARIES.get(x.id).total)
+
+
+@pytest.fixture
+def quoted_card_set(card_set):
+    """A card set whose details need escaping in the XML"""
+    oCS = PhysicalCardSet(name='Quotes "&" <tags>', author="O'Brien",
+                          comment='Caf\xe9 & "friends"',
+                          annotations='<b>bold</b>')
+    for oCard in list(card_set.cards)[:5]:
+        oCS.addPhysicalCard(oCard)
+    yield oCS
+    for oCard in list(oCS.cards):
+        oCS.removePhysicalCard(oCard)
+    oCS.destroySelf()
+
+
+@pytest.mark.parametrize('iChunkCards', [1, 7, 200])
+def test_streamed_xml(card_set, iChunkCards):
+    """The streamed XML matches the writer, however it's split up"""
+    aChunks = list(iter_card_set_xml(card_set, iChunkCards))
+    if iChunkCards == 1:
+        assert len(aChunks) > 2
+    assert b''.join(aChunks) == writer_xml(card_set)
+
+
+def test_streamed_escaped_xml(quoted_card_set):
+    """Card set details which need escaping match the writer"""
+    assert b''.join(iter_card_set_xml(quoted_card_set, 2)) == \
+        writer_xml(quoted_card_set)
+
+
+def test_gzipped_xml(card_set):
+    """The gzipped XML decompresses to the writer's output"""
+    sData = b''.join(gzip_chunks(iter_card_set_xml(card_set, 7)))
+    assert gzip.decompress(sData) == writer_xml(card_set)
+
+
+@pytest.mark.parametrize('sEncoding', ['identity', 'gzip'])
+def test_download_view(client, card_set, sEncoding):
+    """The card set download sends the writer's output"""
+    oResponse = client.post('/cardsetview/%s' % quote(card_set.name),
+                            data={'download': 'Download'},
+                            headers={'Accept-Encoding': sEncoding})
+    assert oResponse.status_code == 200
+    sData = oResponse.data
+    if sEncoding == 'gzip':
+        assert oResponse.content_encoding == 'gzip'
+        sData = gzip.decompress(sData)
+    assert sData == writer_xml(card_set)
+
+
+@pytest.fixture
+def card_set_tree(card_set):
+    """A tree of card sets, including names which would escape the
+       directory they're extracted into if used as they are"""
+    aCards = list(card_set.cards)
+    oRoot = PhysicalCardSet(name='Export Root')
+    oUp = PhysicalCardSet(name='..', parent=oRoot)
+    oHere = PhysicalCardSet(name='.', parent=oUp)
+    oSub = PhysicalCardSet(name='Sub', parent=oUp)
+    oHidden = PhysicalCardSet(name='.hidden', parent=oRoot)
+    aSets = [oRoot, oUp, oHere, oSub, oHidden]
+    for iNum, oCS in enumerate(aSets):
+        for oCard in aCards[iNum:iNum + 3]:
+            oCS.addPhysicalCard(oCard)
+    yield oRoot, [(oRoot, 'Export_Root.xml'),
+                  (oUp, 'Export_Root/_.xml'),
+                  (oHere, 'Export_Root/_/_.xml'),
+                  (oSub, 'Export_Root/_/Sub.xml'),
+                  (oHidden, 'Export_Root/hidden.xml')]
+    for oCS in reversed(aSets):
+        for oCard in list(oCS.cards):
+            oCS.removePhysicalCard(oCard)
+        oCS.destroySelf()
+
+
+def check_zip(sData, aExpected):
+    """Check the zip file has the expected entries, each matching the
+       writer's output for the card set"""
+    oZip = zipfile.ZipFile(BytesIO(sData))
+    assert oZip.namelist() == [x[1] for x in aExpected]
+    for oCS, sName in aExpected:
+        assert oZip.read(sName) == writer_xml(oCS)
+        for sPart in sName.split('/'):
+            assert sPart not in ('', '.', '..')
+
+
+def test_export_file_names(card_set_tree):
+    """The file names can't escape the directory the zip is extracted
+       into"""
+    oRoot, aExpected = card_set_tree
+    assert get_export_files(oRoot) == [(oCS.id, sName)
+                                       for oCS, sName in aExpected]
+
+
+@pytest.mark.parametrize('iWorkers', [0, 4])
+def test_zip_export(card_set_tree, iWorkers):
+    """Each file in the zip matches the writer's output"""
+    oRoot, aExpected = card_set_tree
+    aFiles = get_export_files(oRoot)
+    check_zip(b''.join(iter_card_sets_zip(aFiles, iWorkers)), aExpected)
+
+
+def test_zip_export_view(client, card_set_tree):
+    """The export view sends the zip file"""
+    _oRoot, aExpected = card_set_tree
+    oResponse = client.get('/cardsetexport/Export%20Root')
+    assert oResponse.status_code == 200
+    assert oResponse.mimetype == 'application/zip'
+    check_zip(oResponse.data, aExpected)
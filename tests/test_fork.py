@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check the garbage collector handling around forking workers"""
+
+import gc
+import os
+
+import pytest
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Needs os.fork')
+def test_freeze_only_in_child(web_app):
+    """The startup objects stay frozen in the forked worker, but not in
+       the parent"""
+    assert web_app
+    gc.unfreeze()
+    # Make sure there is something to freeze
+    aObjects = [[] for _iNum in range(10)]
+    iPid = os.fork()
+    if iPid == 0:
+        # The child reports whether its objects are frozen
+        os._exit(0 if gc.get_freeze_count() > 0 else 1)
+    _iPid, iStatus = os.waitpid(iPid, 0)
+    assert os.WIFEXITED(iStatus)
+    assert os.WEXITSTATUS(iStatus) == 0
+    assert gc.get_freeze_count() == 0
+    del aObjects
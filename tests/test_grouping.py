@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check GroupedCards groups the cards in the same way as the groupings"""
+
+import pytest
+from markupsafe import escape
+
+from sutekh.base.core.BaseTables import AbstractCard, PhysicalCardSet
+
+from sutekhweb.grouping import GroupedCards, sort_key
+from sutekhweb.sutekhweb import (ALLOWED_GROUPINGS, CARDSET_SUMMARIES,
+                                 get_card_set_counts, make_count_row)
+
+
+def expected_groups(aItems, cGrouping, fGetCard):
+    """Group the items, sorted by name, with the grouping itself"""
+    aSorted = sorted(aItems, key=lambda x: sort_key(fGetCard(x).name))
+    return [(oKey, list(aGroup)) for oKey, aGroup in
+            cGrouping(aSorted, fGetCard)]
+
+
+@pytest.mark.parametrize('sGrouping', sorted(ALLOWED_GROUPINGS))
+def test_card_list_groups(card_db, sGrouping):
+    """Grouping the card list matches the grouping"""
+    # Start from the cards in id order, so GroupedCards has to sort them
+    aCards = list(AbstractCard.select().orderBy('id'))
+    oGrouped = GroupedCards(aCards, ALLOWED_GROUPINGS)
+    assert oGrouped.group(sGrouping) == expected_groups(
+        aCards, ALLOWED_GROUPINGS[sGrouping], lambda x: x)
+
+
+@pytest.mark.parametrize('sGrouping', sorted(ALLOWED_GROUPINGS))
+def test_card_set_groups(card_db, sGrouping):
+    """Grouping the counts of a card set matches the grouping, and the
+       display rows are grouped in the same way"""
+    # Use the biggest card set, so the groups are well populated
+    oCS = max(PhysicalCardSet.select(),
+              key=lambda x: CARDSET_SUMMARIES.get(x.id).total)
+    dCards, _dCounts = get_card_set_counts(oCS)
+    assert dCards
+    aCounts = list(dCards.values())
+    oGrouped = GroupedCards(aCounts, ALLOWED_GROUPINGS, lambda x: x.card,
+                            make_count_row)
+    aGroups = oGrouped.group(sGrouping)
+    assert aGroups == expected_groups(aCounts, ALLOWED_GROUPINGS[sGrouping],
+                                      lambda x: x.card)
+    aRowGroups = oGrouped.group(sGrouping, bRows=True)
+    assert [x[0] for x in aRowGroups] == [x[0] for x in aGroups]
+    for (_oRowKey, aRows), (_oKey, aItems) in zip(aRowGroups, aGroups):
+        assert [x.name for x in aRows] == [escape(x.card.name)
+                                           for x in aItems]
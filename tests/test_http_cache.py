@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check the cache validators sent with the pages"""
+
+from sutekhweb import sutekhweb
+
+from tests.helpers import write_db
+
+URL = '/cardlist'
+
+
+def test_matching_etag(client):
+    """A request with a matching ETag gets a 304 response"""
+    oResponse = client.get(URL)
+    assert oResponse.status_code == 200
+    sETag = oResponse.headers['ETag']
+    assert oResponse.headers['Last-Modified']
+    oResponse = client.get(URL, headers={'If-None-Match': sETag})
+    assert oResponse.status_code == 304
+    assert oResponse.headers['ETag'] == sETag
+    assert not oResponse.data
+    oResponse = client.get(URL, headers={'If-None-Match': '"other"'})
+    assert oResponse.status_code == 200
+
+
+def test_config_changes_etag(web_app, client):
+    """Changing a setting which changes the pages changes the ETag"""
+    sETag = client.get(URL).headers['ETag']
+    web_app.config['LAZY_GROUPS'] = True
+    sutekhweb.configure_caches()
+    try:
+        oResponse = client.get(URL, headers={'If-None-Match': sETag})
+        assert oResponse.status_code == 200
+        assert oResponse.headers['ETag'] != sETag
+    finally:
+        web_app.config['LAZY_GROUPS'] = False
+        sutekhweb.configure_caches()
+    assert client.get(URL).headers['ETag'] == sETag
+
+
+def test_db_write_changes_etag(card_db, client):
+    """Changing the database changes the ETag"""
+    sETag = client.get(URL).headers['ETag']
+    write_db(card_db, 'UPDATE physical_card_set SET comment = ? '
+             'WHERE id = (SELECT MIN(id) FROM physical_card_set)',
+             ('Changed',))
+    oResponse = client.get(URL, headers={'If-None-Match': sETag})
+    assert oResponse.status_code == 200
+    assert oResponse.headers['ETag'] != sETag
+
+
+def test_no_etag_without_change_detection(client, monkeypatch):
+    """No validators are sent if changes to the database can't be
+       detected"""
+    monkeypatch.setattr(sutekhweb, 'can_detect_changes', lambda: False)
+    oResponse = client.get(URL)
+    assert oResponse.status_code == 200
+    assert 'ETag' not in oResponse.headers
+    assert 'Last-Modified' not in oResponse.headers
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# vim:fileencoding=utf-8 ai ts=4 sts=4 et sw=4
+# Copyright 2012 Neil Muller <drnlmuller+sutekh@gmail.com>
+# GPL - see COPYING for details
+
+"""Check the values kept with the card set summaries follow the database"""
+
+from sutekh.base.core.BaseTables import PhysicalCardSet
+
+from sutekhweb.sutekhweb import CARDSET_SUMMARIES, get_card_set_counts
+
+from tests.helpers import write_db
+
+
+def rename_card(oConn, iCardId, sName):
+    """Rename a card behind SQLObject's back"""
+    write_db(oConn, 'UPDATE abstract_card SET name = ? WHERE id = ?',
+             (sName, iCardId))
+
+
+def test_counts_follow_renames(card_db):
+    """The cached card set counts see changes to the card names"""
+    oCS = [x for x in PhysicalCardSet.select()
+           if CARDSET_SUMMARIES.get(x.id).total][0]
+    dCards, _dCounts = get_card_set_counts(oCS)
+    oCard = min(dCards, key=lambda x: x.id)
+    sName = oCard.name
+    # Check the cached version is used while nothing changes
+    assert get_card_set_counts(oCS)[0] is dCards
+    try:
+        rename_card(card_db, oCard.id, 'Renamed Card')
+        dCards, _dCounts = get_card_set_counts(oCS)
+        assert [x.name for x in dCards if x.id == oCard.id] == \
+            ['Renamed Card']
+    finally:
+        rename_card(card_db, oCard.id, sName)
+    dCards, _dCounts = get_card_set_counts(oCS)
+    assert [x.name for x in dCards if x.id == oCard.id] == [sName]
+
+
+def get_contents(oConn, iCSId):
+    """Return the card counts for the card set, straight from the
+       database"""
+    dCards = {}
+    for iAbsId, iCount in oConn.queryAll(
+            'SELECT pc.abstract_card_id, COUNT(*) '
+            'FROM physical_map pm, physical_card pc '
+            'WHERE pm.physical_card_id = pc.id '
+            'AND pm.physical_card_set_id = %d '
+            'GROUP BY pc.abstract_card_id' % iCSId):
+        dCards[iAbsId] = iCount
+    return dCards
+
+
+def test_summary_follows_same_sum_changes(card_db):
+    """Changing the cards in a card set in a way that keeps the number of
+       cards, the sum of their ids and the largest row id the same is
+       noticed"""
+    oCS = max(PhysicalCardSet.select(),
+              key=lambda x: CARDSET_SUMMARIES.get(x.id).total)
+    aRows = card_db.queryAll(
+        'SELECT id, physical_card_id FROM physical_map '
+        'WHERE physical_card_set_id = %d ORDER BY id' % oCS.id)
+    # Pick two rows whose cards can be moved one id up and one id down
+    # to different abstract cards
+    dAbsIds = dict(card_db.queryAll(
+        'SELECT id, abstract_card_id FROM physical_card'))
+    aChanges = None
+    for iFirst, (iRow1, iCard1) in enumerate(aRows):
+        for iRow2, iCard2 in aRows[iFirst + 1:]:
+            if (iCard1 + 1 != iCard2 and
+                    iCard1 + 1 in dAbsIds and iCard2 - 1 in dAbsIds and
+                    dAbsIds[iCard1 + 1] != dAbsIds[iCard1] and
+                    dAbsIds[iCard2 - 1] != dAbsIds[iCard2]):
+                aChanges = [(iRow1, iCard1, iCard1 + 1),
+                            (iRow2, iCard2, iCard2 - 1)]
+                break
+        if aChanges:
+            break
+    assert aChanges
+    dBefore = get_contents(card_db, oCS.id)
+    assert CARDSET_SUMMARIES.get(oCS.id).dCards == dBefore
+    try:
+        for iRow, _iOld, iNew in aChanges:
+            write_db(card_db, 'UPDATE physical_map SET physical_card_id = ? '
+                     'WHERE id = ?', (iNew, iRow))
+        dExpected = get_contents(card_db, oCS.id)
+        assert dExpected != dBefore
+        assert CARDSET_SUMMARIES.get(oCS.id).dCards == dExpected
+    finally:
+        for iRow, iOld, _iNew in aChanges:
+            write_db(card_db, 'UPDATE physical_map SET physical_card_id = ? '
+                     'WHERE id = ?', (iOld, iRow))
+    assert CARDSET_SUMMARIES.get(oCS.id).dCards == \
+        get_contents(card_db, oCS.id)